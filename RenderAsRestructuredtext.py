@@ -1,16 +1,293 @@
 """
-    MoinMoin - Render as reStructuredText action - redirects to the
+    MoinMoin - Render as reStructuredText action - renders the page with the
     reStructuredText formatter
 
+    The rendering is streamed to the client as it is produced. Renderings
+    are kept in an in-process cache so repeated requests for the same
+    revision are answered without parsing the page again. The size of
+    the cache in bytes is taken from `rst_render_cache_size` in the wiki
+    configuration. ``0`` disables caching. Renderings expanding ``Include``
+    macros are dropped when one of the included pages changes or the user
+    may read other included pages than the user it was rendered for.
+
     @copyright: 2008 Stefan Merten
     @license: GNU GPL, see COPYING for details.
 """
 
+import threading
+
+from MoinMoin import config, wikiutil
 from MoinMoin.Page import Page
-from MoinMoin.util import MoinMoinNoFooter
+from MoinMoin import log
+logging = log.getLogger(__name__)
+
+###############################################################################
+###############################################################################
+# Variables
+
+"""
+@var defaultCacheSize: Size of the render cache in bytes if not configured.
+@type defaultCacheSize: int
+"""
+defaultCacheSize = 16 * 1024 * 1024
+
+###############################################################################
+###############################################################################
+# Classes
+
+class RenderCache(object):
+    """
+    Cache for renderings which drops the least recently used ones when the
+    total size of the renderings exceeds a limit.
+    """
+
+    def __init__(self, maxSize):
+        """
+        @param maxSize: Maximum total size of the renderings in bytes.
+        @type maxSize: int
+        """
+        self.maxSize = maxSize
+        """
+        Current total size of the renderings in bytes.
+        @type: int
+        """
+        self.size = 0
+        """
+        Number of lookups which found a rendering.
+        @type: int
+        """
+        self.hits = 0
+        """
+        Number of lookups which found nothing.
+        @type: int
+        """
+        self.misses = 0
+        """
+        Maps keys to entries of the list of renderings.
+        @type: { tuple: [ list, list, tuple, str, tuple, ], ... }
+        """
+        self._key2Entry = { }
+        """
+        Sentinel of the circular doubly linked list of entries
+        ``[ previous, next, key, rendering, dependencies, ]``. Least recently
+        used entry comes first.
+        @type: list
+        """
+        self._root = [ None, None, None, None, None, ]
+        self._root[0] = self._root[1] = self._root
+        self._lock = threading.Lock()
+
+    def get(self, key, isCurrent=None):
+        """
+        @param isCurrent: Called with the dependencies of the rendering
+                          stored for `key`. If it returns false the
+                          rendering is outdated and dropped.
+        @type isCurrent: callable
+        @return: The rendering stored for `key` or ``None``.
+        @rtype: str
+        """
+        self._lock.acquire()
+        try:
+            entry = self._key2Entry.get(key)
+            if (entry is not None and isCurrent is not None
+                and not isCurrent(entry[4])):
+                self._remove(entry)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            # Move to the most recently used end
+            self._unlink(entry)
+            self._append(entry)
+            return entry[3]
+        finally:
+            self._lock.release()
+
+    def put(self, key, rendering, dependencies=( )):
+        """
+        Store `rendering` for `key` dropping old renderings as needed.
+        Renderings larger than the cache are not stored.
+
+        @param dependencies: Passed to the `isCurrent` callback of `get()`.
+        @type dependencies: tuple
+        """
+        if len(rendering) > self.maxSize:
+            return
+        self._lock.acquire()
+        try:
+            if key in self._key2Entry:
+                self._remove(self._key2Entry[key])
+            entry = [ None, None, key, rendering, dependencies, ]
+            self._key2Entry[key] = entry
+            self._append(entry)
+            self.size += len(rendering)
+            while self.size > self.maxSize:
+                self._remove(self._root[1])
+        finally:
+            self._lock.release()
+
+    def _append(self, entry):
+        last = self._root[0]
+        entry[0] = last
+        entry[1] = self._root
+        last[1] = self._root[0] = entry
+
+    def _unlink(self, entry):
+        entry[0][1] = entry[1]
+        entry[1][0] = entry[0]
+
+    def _remove(self, entry):
+        self._unlink(entry)
+        del self._key2Entry[entry[2]]
+        self.size -= len(entry[3])
+
+###############################################################################
+
+class Tee(object):
+    """
+    Passes everything written to a request on to the client while keeping a
+    copy for the render cache.
+    """
+
+    def __init__(self, request, maxSize):
+        """
+        @param maxSize: Maximum size of the copy kept. If the output grows
+                        larger no copy is kept at all.
+        @type maxSize: int
+        """
+        self._request = request
+        self._write = request.write
+        self._maxSize = maxSize
+        """
+        Encoded output written so far or ``None`` if it grew too large.
+        @type: [ str, ... ]
+        """
+        self.chunks = [ ]
+        self._size = 0
+
+    def write(self, *data):
+        data = self._request.encode(data)
+        self._write(data)
+        if self.chunks is not None:
+            self._size += len(data)
+            if self._size > self._maxSize:
+                self.chunks = None
+            else:
+                self.chunks.append(data)
+
+###############################################################################
+###############################################################################
+# Functions
+
+"""
+@var _cache: The render cache shared by all requests of this process. Created
+             on first use.
+@type _cache: RenderCache
+"""
+_cache = None
+_cacheLock = threading.Lock()
+
+def getCache(request):
+    """
+    @return: The render cache or ``None`` if caching is disabled.
+    @rtype: RenderCache
+    """
+    global _cache
+    if _cache is None:
+        _cacheLock.acquire()
+        try:
+            if _cache is None:
+                _cache = RenderCache(getattr(request.cfg,
+                                             'rst_render_cache_size',
+                                             defaultCacheSize))
+        finally:
+            _cacheLock.release()
+    if not _cache.maxSize:
+        return None
+    return _cache
+
+def render(request, Formatter, pagename, rev, maxSize):
+    """
+    Render the page as reStructuredText and send it to the client.
+
+    @param maxSize: Maximum size of a rendering to be returned.
+    @return: The rendering encoded for output or ``None`` if larger than
+             `maxSize` and the pages included by the rendering with their
+             revisions and whether the user may read them.
+    @rtype: ( str, ( ( unicode, int, bool, ), ... ), )
+    """
+    formatter = Formatter(request)
+    page = Page(request, pagename, rev=rev, formatter=formatter)
+    tee = Tee(request, maxSize)
+    request.redirect(tee)
+    try:
+        page.send_page(emit_headers=0, count_hit=0)
+    finally:
+        request.redirect()
+    # Includes are expanded only if the user may read them
+    includedPages = tuple(sorted([ ( pageName, revision,
+                                     formatter.includeAccess.get(pageName), )
+                                   for ( pageName, revision, )
+                                   in formatter.includedPages.items() ]))
+    if tee.chunks is None:
+        return ( None, includedPages, )
+    return ( "".join(tee.chunks), includedPages, )
+
+def includesUnchanged(request, includedPages):
+    """
+    @param includedPages: Pages included by a rendering as returned by
+                          `render()` and stored in the render cache.
+    @type includedPages: ( ( unicode, int, bool, ), ... )
+    @return: Whether all included pages are still at these revisions and
+             the user of `request` may read the same of them. Pages recorded
+             with revision ``0`` must still not exist.
+    @rtype: bool
+    """
+    for ( pageName, revision, readable, ) in includedPages:
+        page = Page(request, pageName)
+        if (page.exists() and page.get_real_rev() or 0) != revision:
+            return False
+        if (readable is not None
+            and bool(request.user.may.read(pageName)) != readable):
+            return False
+    return True
 
 def execute(pagename, request):
-    url = Page(request, pagename).url(request, {'action': 'format',
-                                                'mimetype': 'text/x-rst'}, 0)
-    request.http_redirect(url)
-    raise MoinMoinNoFooter
+    page = Page(request, pagename, rev=request.rev or 0)
+    if not page.exists():
+        request.makeForbidden(404, 'No page named "%s"!\r\n'
+                              % ( pagename.encode(config.charset), ))
+        return
+    if not request.user.may.read(pagename):
+        request.makeForbidden403()
+        return
+
+    Formatter = wikiutil.importPlugin(request.cfg, "formatter",
+                                      "text_x-rst", "Formatter")
+    # Resolved once so a page saved meanwhile is not rendered and cached
+    # under the revision before
+    rev = page.get_real_rev()
+    cache = getCache(request)
+    key = ( request.cfg.siteid, pagename, rev, Formatter.version, )
+    rendering = None
+    if cache:
+        rendering = cache.get(key, lambda includedPages:
+                                  includesUnchanged(request, includedPages))
+        logging.debug("render cache %s for %r: %d hits, %d misses, %d bytes"
+                      % ( rendering is None and "miss" or "hit", key,
+                          cache.hits, cache.misses, cache.size, ))
+
+    request.setHttpHeader("Content-Type: text/x-rst; charset=%s"
+                          % ( config.charset, ))
+    request.setHttpHeader("Status: 200 OK")
+    request.emit_http_headers()
+    if rendering is not None:
+        request.write(rendering)
+    elif cache:
+        rendering, includedPages = render(request, Formatter, pagename, rev,
+                                          cache.maxSize)
+        if rendering is not None:
+            cache.put(key, rendering, includedPages)
+    else:
+        render(request, Formatter, pagename, rev, 0)
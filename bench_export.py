@@ -0,0 +1,507 @@
+#! /usr/bin/env python
+# -*- coding: iso-8859-1 -*-
+
+"""
+End-to-end benchmark of the conversion by "moin2rst.py".
+
+A synthetic MoinMoin data directory is generated and converted in bulk
+mode by "moin2rst.py" running as a process of its own exactly as a user
+would run it. Reported are pages and megabytes converted per second, the
+latency of single pages and the peak memory. The results can be saved as
+JSON and compared against those of an earlier run.
+"""
+
+###############################################################################
+###############################################################################
+# Import
+
+import sys
+import os
+import math
+import json
+import random
+import shutil
+import tempfile
+import time
+import resource
+import subprocess
+
+from optparse import OptionParser, OptionGroup
+
+###############################################################################
+###############################################################################
+# Variables
+
+"""
+@var options: Options given on the command line
+@type options: optparse.Values
+"""
+global options
+
+"""
+@var metrics: Results compared against a baseline as pairs of key and
+              whether larger is better.
+@type metrics: [ ( str, bool, ), ... ]
+"""
+metrics = [ ( "pagesPerSecond", True, ),
+            ( "megabytesPerSecond", True, ),
+            ( "latencyP50", False, ),
+            ( "latencyP99", False, ),
+            ( "peakRss", False, ), ]
+
+###############################################################################
+###############################################################################
+# Functions
+
+def parseOptions():
+    """
+    Sets options and returns arguments.
+
+    @return: Options passed on to "moin2rst.py".
+    @rtype: [ str, ... ]
+    """
+    global options
+    optionParser = OptionParser(usage="usage: %prog [option]... [-- <moin2rst option>...]",
+                                description="""Benchmark the conversion of a generated wiki by "moin2rst.py".""")
+
+    generalGroup = OptionGroup(optionParser, "General options")
+    generalGroup.add_option("-d", "--directory",
+                            default=".", dest="directory",
+                            help="""Directory where the configuration of a wiki lives. Only its configuration
+is used for the conversion; the pages are generated.
+
+Defaults to ".".""")
+    generalGroup.add_option("-s", "--script",
+                            default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                 "moin2rst.py"),
+                            dest="script",
+                            help="""Path of the conversion script to benchmark.
+
+Defaults to "moin2rst.py" next to this script.""")
+    generalGroup.add_option("-w", "--work-directory",
+                            default=None, dest="work_directory",
+                            help="""Directory to generate the wiki and write the output to. It is kept after the
+benchmark and a wiki generated before is used again.
+
+Defaults to a temporary directory removed after the benchmark.""")
+    generalGroup.add_option("-r", "--repeat",
+                            default=1, type=int, dest="repeat",
+                            help="""Number of conversions. The results of the fastest one are reported. Peak
+memory is the largest of all conversions.
+
+Defaults to 1.""")
+    generalGroup.add_option("-o", "--output",
+                            default=None, dest="output",
+                            help="""Write the results to the file "output" as JSON.""")
+    generalGroup.add_option("-b", "--baseline",
+                            default=None, dest="baseline",
+                            help="""Compare the results against those in the file "baseline" as written by
+-o/--output before.""")
+    optionParser.add_option_group(generalGroup)
+
+    wikiGroup = OptionGroup(optionParser, "Wiki options",
+                            """The generated wiki depends only on these options. Sizes may be given with
+"k" and "m" multiplying by 1024 and 1024 * 1024 respectively.""")
+    wikiGroup.add_option("-n", "--pages",
+                         default="1k", dest="pages",
+                         help="""Number of pages.
+
+Defaults to "1k".""")
+    wikiGroup.add_option("-S", "--size",
+                         default="4k", dest="size",
+                         help="""Mean size of a page in characters. Sizes are distributed log-normally so
+there are many small and a few big pages.
+
+Defaults to "4k".""")
+    wikiGroup.add_option("--spread",
+                         default=1.0, type=float, dest="spread",
+                         help="""Standard deviation of the logarithm of the page sizes. 0 makes all pages
+the same size.
+
+Defaults to 1.0.""")
+    wikiGroup.add_option("-l", "--links",
+                         default=5.0, type=float, dest="links",
+                         help="""Links to other pages per 1024 characters. Links are absolute or relative to
+the parent, siblings and children of the page.
+
+Defaults to 5.""")
+    wikiGroup.add_option("-f", "--footnotes",
+                         default=0.5, type=float, dest="footnotes",
+                         help="""Footnotes per 1024 characters.
+
+Defaults to 0.5.""")
+    wikiGroup.add_option("-t", "--contents",
+                         default=0.2, type=float, dest="contents",
+                         help="""Fraction of pages starting with a table of contents.
+
+Defaults to 0.2.""")
+    wikiGroup.add_option("-D", "--depth",
+                         default=3, type=int, dest="depth",
+                         help="""Maximum nesting depth of subpages.
+
+Defaults to 3.""")
+    wikiGroup.add_option("--seed",
+                         default=0, type=int, dest="seed",
+                         help="""Seed of the random numbers generating the wiki.
+
+Defaults to 0.""")
+    optionParser.add_option_group(wikiGroup)
+
+    ( options, args, ) = optionParser.parse_args()
+
+    try:
+        options.pages = parseSize(options.pages)
+        options.size = parseSize(options.size)
+    except ValueError:
+        optionParser.error("-n/--pages and -S/--size must be sizes")
+    if options.pages < 1 or options.size < 1:
+        optionParser.error("-n/--pages and -S/--size must be at least 1")
+    if options.depth < 1:
+        optionParser.error("-D/--depth must be at least 1")
+    if options.repeat < 1:
+        optionParser.error("-r/--repeat must be at least 1")
+    if options.spread < 0:
+        optionParser.error("--spread must not be negative")
+
+    return args
+
+def parseSize(size):
+    """
+    @return: `size` with "k" and "m" suffixes applied.
+    @rtype: int
+    """
+    size = size.strip().lower()
+    for ( suffix, factor, ) in ( ( "k", 1024, ), ( "m", 1024 * 1024, ), ):
+        if size.endswith(suffix):
+            return int(size[:-len(suffix)]) * factor
+    return int(size)
+
+###############################################################################
+
+def pageNames(random):
+    """
+    @return: Names of the pages of the wiki. Pages are spread over a tree of
+             subpages so relative links have parents, siblings and children
+             to point to.
+    @rtype: [ unicode, ... ]
+    """
+    names = [ ]
+    for index in xrange(options.pages):
+        if not names or random.random() < 0.3:
+            names.append(u"Bench%d" % ( index, ))
+        else:
+            parent = random.choice(names)
+            if parent.count(u"/") + 1 < options.depth:
+                names.append(u"%s/Sub%d" % ( parent, index, ))
+            else:
+                names.append(u"%s/Sub%d" % ( parent.rsplit(u"/", 1)[0],
+                                             index, ))
+    return names
+
+def linkTargets(names):
+    """
+    @return: Maps every page name to relative links to other pages.
+    @rtype: { unicode: [ unicode, ... ], ... }
+    """
+    children = { }
+    for name in names:
+        if u"/" in name:
+            children.setdefault(name.rsplit(u"/", 1)[0], [ ]).append(name)
+    targets = { }
+    for name in names:
+        links = [ u"/" + child.rsplit(u"/", 1)[1]
+                  for child in children.get(name, [ ]) ]
+        if u"/" in name:
+            parent = name.rsplit(u"/", 1)[0]
+            links.append(u"..")
+            links.extend([ u"../" + sibling.rsplit(u"/", 1)[1]
+                           for sibling in children[parent]
+                           if sibling != name ])
+        targets[name] = links
+    return targets
+
+_words = u"""lorem ipsum dolor sit amet consectetur adipisici elit sed eiusmod
+tempor incidunt ut labore et dolore magna aliqua""".split()
+
+def pageText(random, name, names, relatives, size):
+    """
+    @return: Wiki markup of about `size` characters for the page `name`.
+    @rtype: unicode
+    """
+    parts = [ ]
+    length = 0
+    if random.random() < options.contents:
+        parts.append(u"<<TableOfContents>>\n\n")
+    # Probabilities per word of about six characters
+    linkRate = options.links * 6 / 1024
+    footnoteRate = options.footnotes * 6 / 1024
+    section = 0
+    while length < size:
+        if section % 4 == 0:
+            parts.append(u"= Section %d =\n\n" % ( section, ))
+        elif section % 2 == 0:
+            parts.append(u"== Subsection %d ==\n\n" % ( section, ))
+        section += 1
+        bullets = random.random() < 0.3
+        for line in xrange(random.randint(2, 6)):
+            words = [ ]
+            for word in xrange(random.randint(8, 30)):
+                draw = random.random()
+                if draw < linkRate:
+                    if relatives[name] and random.random() < 0.5:
+                        words.append(u"[[%s]]"
+                                     % ( random.choice(relatives[name]), ))
+                    else:
+                        words.append(u"[[%s]]" % ( random.choice(names), ))
+                elif draw < linkRate + footnoteRate:
+                    words.append(u"<<FootNote(%s)>>"
+                                 % ( u" ".join(random.sample(_words, 4)), ))
+                elif draw < 0.1:
+                    words.append(u"'''%s'''" % ( random.choice(_words), ))
+                elif draw < 0.15:
+                    words.append(u"''%s''" % ( random.choice(_words), ))
+                else:
+                    words.append(random.choice(_words))
+            text = u" ".join(words)
+            if bullets:
+                text = u" * " + text
+            parts.append(text + u"\n")
+            length += len(text) + 1
+        parts.append(u"\n")
+        if random.random() < 0.1:
+            parts.append(u"{{{\n%s\n}}}\n\n"
+                         % ( u"\n".join(random.sample(_words, 5)), ))
+    return u"".join(parts)
+
+def generateWiki(dataDirectory):
+    """
+    Generate the pages of the wiki in `dataDirectory`.
+
+    @return: Total size of all pages in bytes.
+    @rtype: int
+    """
+    from MoinMoin import wikiutil
+
+    generator = random.Random(options.seed)
+    names = pageNames(generator)
+    relatives = linkTargets(names)
+    # Mean of a log-normal distribution is exp(mu + sigma ** 2 / 2)
+    mu = math.log(options.size) - options.spread ** 2 / 2
+    total = 0
+    for name in names:
+        size = int(generator.lognormvariate(mu, options.spread))
+        text = pageText(generator, name, names, relatives,
+                        max(size, 1)).encode("utf-8")
+        path = os.path.join(dataDirectory, "pages",
+                            wikiutil.quoteWikinameFS(name))
+        os.makedirs(os.path.join(path, "revisions"))
+        writeFile(os.path.join(path, "current"), "00000001\n")
+        writeFile(os.path.join(path, "revisions", "00000001"), text)
+        total += len(text)
+    return total
+
+def writeFile(path, data):
+    file = open(path, "wb")
+    try:
+        file.write(data)
+    finally:
+        file.close()
+
+def wikiParameters():
+    """
+    @return: The options determining the generated wiki.
+    @rtype: { str: object, ... }
+    """
+    return dict([ ( name, getattr(options, name), )
+                  for name in ( "pages", "size", "spread", "links",
+                                "footnotes", "contents", "depth",
+                                "seed", ) ])
+
+def prepareWiki(workDirectory):
+    """
+    Generate the wiki in `workDirectory` unless generated there before with
+    the same parameters.
+
+    @return: Data directory of the wiki and the total size of all pages.
+    @rtype: ( str, int, )
+    """
+    dataDirectory = os.path.join(workDirectory, "data")
+    parametersPath = os.path.join(workDirectory, "parameters.json")
+    parameters = wikiParameters()
+    try:
+        file = open(parametersPath)
+        try:
+            generated = json.load(file)
+        finally:
+            file.close()
+        if generated["parameters"] == parameters:
+            return ( dataDirectory, generated["bytes"], )
+    except ( IOError, ValueError, KeyError, ):
+        pass
+
+    if os.path.exists(dataDirectory):
+        shutil.rmtree(dataDirectory)
+    sys.stderr.write("Generating %d pages...\n" % ( options.pages, ))
+    size = generateWiki(dataDirectory)
+    writeFile(parametersPath, json.dumps({ "parameters": parameters,
+                                           "bytes": size, }))
+    return ( dataDirectory, size, )
+
+###############################################################################
+
+def percentile(values, fraction):
+    """
+    @param values: Sorted values.
+    @return: The value `fraction` of all values are smaller than or equal
+             to.
+    """
+    if not values:
+        return None
+    index = int(math.ceil(fraction * len(values))) - 1
+    return values[min(max(index, 0), len(values) - 1)]
+
+def _childrenMaxRss():
+    """
+    @return: Peak resident set size of the largest child process waited for
+             so far in bytes.
+    @rtype: int
+    """
+    return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+
+def convertWiki(workDirectory, dataDirectory, size, arguments):
+    """
+    Convert the generated wiki once.
+
+    @param arguments: Additional options for the conversion script.
+    @return: The results of the conversion.
+    @rtype: { str: object, ... }
+    """
+    outputDirectory = os.path.join(workDirectory, "output")
+    if os.path.exists(outputDirectory):
+        shutil.rmtree(outputDirectory)
+    timingsPath = os.path.join(workDirectory, "timings.json")
+    logPath = os.path.join(workDirectory, "moin2rst.log")
+    log = open(logPath, "w")
+    try:
+        start = time.time()
+        status = subprocess.call([ sys.executable, options.script,
+                                   "-d", options.directory,
+                                   "-D", dataDirectory, "-a",
+                                   "-o", outputDirectory,
+                                   "--timings", timingsPath, ]
+                                 + arguments, stderr=log)
+        seconds = max(time.time() - start, 1e-6)
+    finally:
+        log.close()
+    if status not in ( 0, 1, ):
+        # 1 only reports pages which failed
+        sys.stderr.write(open(logPath).read())
+        raise RuntimeError("%s exited with status %d"
+                           % ( options.script, status, ))
+
+    file = open(timingsPath)
+    try:
+        latencies = sorted(json.load(file).values())
+    finally:
+        file.close()
+    return { "seconds": seconds,
+             "pages": len(latencies),
+             "failed": options.pages - len(latencies),
+             "bytes": size,
+             "pagesPerSecond": len(latencies) / seconds,
+             "megabytesPerSecond": size / seconds / 1024 / 1024,
+             "latencyP50": percentile(latencies, 0.5),
+             "latencyP99": percentile(latencies, 0.99),
+             "latencyMax": percentile(latencies, 1.0), }
+
+def benchmark(arguments):
+    """
+    Generate the wiki, convert it and report the results.
+
+    @return: The results of the fastest conversion.
+    @rtype: { str: object, ... }
+    """
+    workDirectory = options.work_directory
+    if workDirectory is None:
+        workDirectory = tempfile.mkdtemp(prefix="bench_export.")
+    else:
+        workDirectory = os.path.abspath(workDirectory)
+        if not os.path.isdir(workDirectory):
+            os.makedirs(workDirectory)
+    try:
+        ( dataDirectory, size, ) = prepareWiki(workDirectory)
+        best = None
+        for run in xrange(options.repeat):
+            results = convertWiki(workDirectory, dataDirectory, size,
+                                  arguments)
+            sys.stderr.write("Run %d: %.3f seconds\n"
+                             % ( run + 1, results["seconds"], ))
+            if best is None or results["seconds"] < best["seconds"]:
+                best = results
+    finally:
+        if options.work_directory is None:
+            shutil.rmtree(workDirectory)
+    best["peakRss"] = _childrenMaxRss()
+    best["parameters"] = wikiParameters()
+    best["arguments"] = arguments
+    return best
+
+def report(results, baseline):
+    """
+    Write `results` and their change against `baseline` to stdout.
+
+    @param baseline: Results of an earlier run or ``None``.
+    """
+    sys.stdout.write("%d pages, %.2f MB, %d failed, %.3f seconds\n"
+                     % ( results["pages"], results["bytes"] / 1024.0 / 1024,
+                         results["failed"], results["seconds"], ))
+    if baseline is not None:
+        for key in ( "parameters", "arguments", ):
+            if baseline.get(key) != results[key]:
+                sys.stdout.write("Warning: %s differ from the baseline\n"
+                                 % ( key, ))
+    sys.stdout.write("%-20s %14s %14s %9s\n"
+                     % ( "metric", "value", "baseline", "change", ))
+    for ( key, largerIsBetter, ) in metrics:
+        value = results[key]
+        line = "%-20s %14s" % ( key, formatValue(key, value), )
+        if baseline is not None and baseline.get(key):
+            change = (value - baseline[key]) / float(baseline[key]) * 100
+            line += " %14s %+8.1f%%" % ( formatValue(key, baseline[key]),
+                                         change, )
+        sys.stdout.write(line + "\n")
+
+def formatValue(key, value):
+    """
+    @return: `value` of the metric `key` formatted for the report.
+    @rtype: str
+    """
+    if value is None:
+        return "-"
+    if key == "peakRss":
+        return "%.1f MB" % ( value / 1024.0 / 1024, )
+    if key.startswith("latency"):
+        return "%.2f ms" % ( value * 1000, )
+    return "%.2f" % ( value, )
+
+###############################################################################
+###############################################################################
+# Now work
+
+if __name__ == '__main__':
+    arguments = parseOptions()
+    baseline = None
+    if options.baseline:
+        file = open(options.baseline)
+        try:
+            baseline = json.load(file)
+        finally:
+            file.close()
+    results = benchmark(arguments)
+    report(results, baseline)
+    if options.output:
+        file = open(options.output, "w")
+        try:
+            json.dump(results, file, indent=1, sort_keys=True)
+        finally:
+            file.close()
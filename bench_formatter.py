@@ -0,0 +1,602 @@
+#! /usr/bin/env python
+# -*- coding: iso-8859-1 -*-
+
+"""
+Benchmarks for the reStructuredText formatter.
+
+The formatter is driven directly using stand-ins for the MoinMoin request
+and page so no wiki is needed. MoinMoin itself must be importable, however.
+
+Two benchmarks are available. "features" exercises single formatter
+features and reports operations per second and peak memory for each.
+"scaling" renders whole pages of increasing size to reveal non-linear
+behavior.
+
+With -R/--check-reset nothing is benchmarked. Instead it is checked that a
+formatter reset after rendering a page renders the next page exactly like a
+new formatter does.
+"""
+
+###############################################################################
+###############################################################################
+# Import
+
+import sys
+import os
+import imp
+import time
+import resource
+import multiprocessing
+
+from optparse import OptionParser, OptionGroup
+
+###############################################################################
+###############################################################################
+# Variables
+
+"""
+@var options: Options given on the command line
+@type options: optparse.Values
+"""
+global options
+
+"""
+@var Formatter: The formatter class benchmarked.
+@type Formatter: type
+"""
+Formatter = None
+
+###############################################################################
+###############################################################################
+# Classes
+
+class FakeRequest(object):
+    """
+    Provides what the formatter needs from a MoinMoin request.
+    """
+
+    def getText(self, text, **kw):
+        return text
+
+    def normalizePagename(self, name):
+        return u"/".join([ part.strip()
+                           for part in name.split(u"/")
+                           if part.strip() ])
+
+class FakePage(object):
+    """
+    Provides what the formatter needs from a MoinMoin page.
+    """
+
+    def __init__(self, page_name, header=u"#format wiki\n"):
+        self.page_name = page_name
+        self._header = header
+
+    def getPageHeader(self):
+        return self._header
+
+class CountingSink(object):
+    """
+    Sink which only counts the characters written.
+    """
+
+    def __init__(self):
+        self.size = 0
+
+    def write(self, text):
+        self.size += len(text)
+
+class StringSink(object):
+    """
+    Sink which keeps everything written.
+    """
+
+    def __init__(self):
+        self._parts = [ ]
+
+    def write(self, text):
+        self._parts.append(text)
+
+    def getvalue(self):
+        return u"".join(self._parts)
+
+###############################################################################
+###############################################################################
+# Functions
+
+def parseOptions():
+    """
+    Sets options and returns arguments.
+
+    @return: Nothing.
+    @rtype: ( )
+    """
+    global options
+    optionParser = OptionParser(usage="usage: %prog [option]...",
+                                description="""Benchmark the reStructuredText formatter.""")
+
+    generalGroup = OptionGroup(optionParser, "General options")
+    generalGroup.add_option("-f", "--formatter",
+                            default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                 "text_x-rst.py"),
+                            dest="formatter",
+                            help="""Path of the formatter plugin to benchmark.
+
+Defaults to "text_x-rst.py" next to this script.""")
+    generalGroup.add_option("-b", "--benchmark",
+                            default="features", dest="benchmark",
+                            type="choice", choices=( "features", "scaling", ),
+                            help="""Benchmark to run. One of "features" or "scaling".
+
+Defaults to "features".""")
+    generalGroup.add_option("-R", "--check-reset",
+                            default=False, action="store_true", dest="check_reset",
+                            help="""Instead of benchmarking render every feature after every other feature
+with a formatter reset in between and compare the output with that of a
+new formatter. Uses -D/--depth. Exits with status 1 if any output differs.""")
+    optionParser.add_option_group(generalGroup)
+
+    featuresGroup = OptionGroup(optionParser, "Features options")
+    featuresGroup.add_option("-F", "--features",
+                             default=None, dest="features",
+                             help="""Comma separated list of features to benchmark. Available are %s.
+
+Defaults to all features."""
+                             % ( ", ".join([ '"%s"' % ( name, )
+                                             for ( name, feature, ) in features ]), ))
+    featuresGroup.add_option("-n", "--operations",
+                             default="100k", dest="operations",
+                             help="""Number of operations per feature. "k" and "m" multiply by 1024 and
+1024 * 1024 respectively.
+
+Defaults to "100k".""")
+    featuresGroup.add_option("-D", "--depth",
+                             default=3, type=int, dest="depth",
+                             help="""Nesting depth of inline styles and lists, number of lines of
+preformatted blocks and number of table columns.
+
+Defaults to 3.""")
+    optionParser.add_option_group(featuresGroup)
+
+    scalingGroup = OptionGroup(optionParser, "Scaling options")
+    scalingGroup.add_option("-s", "--sizes",
+                            default="10k,100k,1m,10m,50m", dest="sizes",
+                            help="""Comma separated list of page sizes to render. "k" and "m" multiply by 1024
+and 1024 * 1024 respectively.
+
+Defaults to "10k,100k,1m,10m,50m".""")
+    optionParser.add_option_group(scalingGroup)
+
+    ( options, args, ) = optionParser.parse_args()
+
+    if args:
+        optionParser.error("No argument allowed")
+
+    try:
+        options.sizes = [ parseSize(size)
+                          for size in options.sizes.split(",") ]
+    except ValueError:
+        optionParser.error("-s/--sizes must be a list of sizes")
+    try:
+        options.operations = parseSize(options.operations)
+    except ValueError:
+        optionParser.error("-n/--operations must be a size")
+    if options.depth < 1:
+        optionParser.error("-D/--depth must be at least 1")
+    name2Feature = dict(features)
+    if options.features is None:
+        options.features = features
+    else:
+        try:
+            options.features = [ ( name, name2Feature[name], )
+                                 for name in [ name.strip()
+                                               for name in options.features.split(",") ] ]
+        except KeyError, e:
+            optionParser.error("-F/--features: Unknown feature %s" % ( e, ))
+
+    return args
+
+def parseSize(size):
+    """
+    @return: `size` with "k" and "m" suffixes applied.
+    @rtype: int
+    """
+    size = size.strip().lower()
+    for ( suffix, factor, ) in ( ( "k", 1024, ), ( "m", 1024 * 1024, ), ):
+        if size.endswith(suffix):
+            return int(size[:-len(suffix)]) * factor
+    return int(size)
+
+def loadFormatter(path):
+    """
+    @return: The formatter class of the plugin in `path`.
+    """
+    from MoinMoin import i18n
+    if i18n.languages is None:
+        # Importing the wiki parser needs the list of languages which is
+        # usually loaded by the first request
+        i18n.languages = { }
+    return imp.load_source("text_x_rst", path).Formatter
+
+def createFormatter(sink=None):
+    """
+    @return: A formatter set up for a fake page.
+    """
+    formatter = Formatter(FakeRequest(), sink=sink)
+    formatter.setPage(FakePage(u"Bench/Page"))
+    return formatter
+
+def renderFeature(formatter, feature):
+    """
+    Render a short page exercising `feature` with `formatter`.
+    """
+    feature(formatter, 20, options.depth)
+    formatter.endContent()
+
+###############################################################################
+
+# Page shapes. Each function emits about `size` characters of text through
+# the formatter.
+
+_words = u"Lorem ipsum dolor sit amet, consectetur adipisici elit "
+
+def paragraphs(formatter, size):
+    """
+    Paragraphs of text with some strong and emphasized words.
+    """
+    result = [ ]
+    while size > 0:
+        result.append(formatter.paragraph(1))
+        for i in range(10):
+            result.append(formatter.text(_words))
+            result.append(formatter.strong(1))
+            result.append(formatter.text(u"strong"))
+            result.append(formatter.strong(0))
+            result.append(formatter.text(u" "))
+            result.append(formatter.emphasis(1))
+            result.append(formatter.text(u"emphasis"))
+            result.append(formatter.emphasis(0))
+            result.append(formatter.text(u" "))
+        result.append(formatter.paragraph(0))
+        size -= 10 * (len(_words) + 16)
+    return result
+
+def preformatted(formatter, size):
+    """
+    A single preformatted block made of many lines.
+    """
+    result = [ formatter.preformatted(1) ]
+    while size > 0:
+        result.append(formatter.text(_words + u"\n"))
+        size -= len(_words) + 1
+    result.append(formatter.preformatted(0))
+    return result
+
+def longInline(formatter, size):
+    """
+    One paragraph in a single inline style.
+    """
+    result = [ formatter.paragraph(1), formatter.strong(1) ]
+    while size > 0:
+        result.append(formatter.text(_words))
+        size -= len(_words)
+    result.append(formatter.strong(0))
+    result.append(formatter.paragraph(0))
+    return result
+
+def links(formatter, size):
+    """
+    Paragraphs of links to distinct pages, some sharing their target.
+    """
+    result = [ ]
+    i = 0
+    while size > 0:
+        result.append(formatter.paragraph(1))
+        for j in range(10):
+            result.append(formatter.pagelink(1, u"Bench/Target%d" % ( i / 2, )))
+            result.append(formatter.text(u"Link number %d" % ( i, )))
+            result.append(formatter.pagelink(0))
+            result.append(formatter.text(u" "))
+            i += 1
+        result.append(formatter.paragraph(0))
+        size -= 200
+    return result
+
+def inlineDense(formatter, size):
+    """
+    A table like an API reference with several inline styles in every cell.
+    """
+    result = [ formatter.table(1) ]
+    i = 0
+    while size > 0:
+        result.append(formatter.table_row(1))
+        result.append(formatter.table_cell(1))
+        result.append(formatter.code(1))
+        result.append(formatter.text(u"function%d()" % ( i, )))
+        result.append(formatter.code(0))
+        result.append(formatter.table_cell(0))
+        result.append(formatter.table_cell(1))
+        for word in ( u"Returns ", u"the ", u"value ", u"of ", ):
+            result.append(formatter.text(word))
+            result.append(formatter.code(1))
+            result.append(formatter.text(u"arg"))
+            result.append(formatter.code(0))
+            result.append(formatter.text(u" "))
+        result.append(formatter.emphasis(1))
+        result.append(formatter.text(u"or "))
+        result.append(formatter.strong(1))
+        result.append(formatter.text(u"None"))
+        result.append(formatter.strong(0))
+        result.append(formatter.emphasis(0))
+        result.append(formatter.table_cell(0))
+        result.append(formatter.table_row(0))
+        i += 1
+        size -= 80
+    result.append(formatter.table(0))
+    return result
+
+"""
+@var shapes: Page shapes benchmarked.
+@type shapes: [ ( str, callable, ), ... ]
+"""
+shapes = [ ( "paragraphs", paragraphs, ),
+           ( "preformatted", preformatted, ),
+           ( "long-inline", longInline, ),
+           ( "links", links, ),
+           ( "inline-dense", inlineDense, ), ]
+
+###############################################################################
+
+# Features. Each function performs `count` operations exercising one feature
+# of the formatter. `depth` controls the shape of a single operation.
+
+def textFeature(formatter, count, depth):
+    """
+    Plain text in paragraphs of ten calls each.
+    """
+    for i in xrange(count):
+        if not i % 10:
+            formatter.paragraph(1)
+        formatter.text(_words)
+        if i % 10 == 9:
+            formatter.paragraph(0)
+
+def inlineFeature(formatter, count, depth):
+    """
+    Alternating strong and emphasis styles nested `depth` levels deep.
+    """
+    styles = ( formatter.strong, formatter.emphasis, )
+    for i in xrange(count):
+        if not i % 10:
+            formatter.paragraph(1)
+        for level in xrange(depth):
+            styles[level % 2](1)
+            formatter.text(u"word ")
+        for level in reversed(xrange(depth)):
+            formatter.text(u" word")
+            styles[level % 2](0)
+        formatter.text(u" ")
+        if i % 10 == 9:
+            formatter.paragraph(0)
+
+def pagelinkFeature(formatter, count, depth):
+    """
+    Links to sibling, child and unrelated pages. Every target is linked
+    twice with different descriptions.
+    """
+    targets = ( u"Bench/Sibling%d", u"Bench/Page/Child%d", u"Other/Page%d", )
+    for i in xrange(count):
+        if not i % 10:
+            formatter.paragraph(1)
+        formatter.pagelink(1, targets[i % 3] % ( i / 6, ))
+        formatter.text(u"Link %d" % ( i, ))
+        formatter.pagelink(0)
+        formatter.text(u" ")
+        if i % 10 == 9:
+            formatter.paragraph(0)
+
+def _listFeature(formatter, count, depth, list):
+    for i in xrange(count):
+        for level in xrange(depth):
+            list(1)
+            formatter.listitem(1)
+            formatter.paragraph(1)
+            formatter.text(_words)
+            formatter.paragraph(0)
+        for level in xrange(depth):
+            formatter.listitem(0)
+            list(0)
+
+def bulletListFeature(formatter, count, depth):
+    """
+    Bullet lists nested `depth` levels deep.
+    """
+    _listFeature(formatter, count, depth, formatter.bullet_list)
+
+def numberListFeature(formatter, count, depth):
+    """
+    Number lists nested `depth` levels deep.
+    """
+    _listFeature(formatter, count, depth, formatter.number_list)
+
+def headingFeature(formatter, count, depth):
+    """
+    Headings of all levels followed by a short paragraph.
+    """
+    for i in xrange(count):
+        level = i % 6 + 1
+        formatter.heading(1, level)
+        formatter.text(u"Heading number %d" % ( i, ))
+        formatter.heading(0, level)
+        formatter.paragraph(1)
+        formatter.text(_words)
+        formatter.paragraph(0)
+
+def footnoteFeature(formatter, count, depth):
+    """
+    Paragraphs with footnotes which are output at the end of the page.
+    """
+    for i in xrange(count):
+        formatter.paragraph(1)
+        formatter.text(_words)
+        formatter.macro(None, u"FootNote", u"Footnote number %d" % ( i, ))
+        formatter.paragraph(0)
+
+def preformattedFeature(formatter, count, depth):
+    """
+    Preformatted blocks of `depth` lines.
+    """
+    for i in xrange(count):
+        formatter.preformatted(1)
+        for line in xrange(depth):
+            formatter.text(_words + u"\n")
+        formatter.preformatted(0)
+
+def _tableFeature(formatter, count, depth, text):
+    formatter.table(1)
+    for i in xrange(count):
+        formatter.table_row(1)
+        for column in xrange(depth):
+            formatter.table_cell(1)
+            formatter.text(text)
+            formatter.table_cell(0)
+        formatter.table_row(0)
+    formatter.table(0)
+
+def tableFeature(formatter, count, depth):
+    """
+    A table of `count` rows with `depth` narrow columns output as a grid
+    table.
+    """
+    _tableFeature(formatter, count, depth, u"cell")
+
+def wideTableFeature(formatter, count, depth):
+    """
+    A table of `count` rows with `depth` wide columns output as a list table.
+    """
+    _tableFeature(formatter, count, depth, _words)
+
+"""
+@var features: Features benchmarked.
+@type features: [ ( str, callable, ), ... ]
+"""
+features = [ ( "text", textFeature, ),
+             ( "inline", inlineFeature, ),
+             ( "pagelink", pagelinkFeature, ),
+             ( "bullet_list", bulletListFeature, ),
+             ( "number_list", numberListFeature, ),
+             ( "heading", headingFeature, ),
+             ( "footnote", footnoteFeature, ),
+             ( "preformatted", preformattedFeature, ),
+             ( "table", tableFeature, ),
+             ( "wide_table", wideTableFeature, ), ]
+
+###############################################################################
+
+def _maxRss():
+    """
+    @return: Peak resident set size of this process in bytes.
+    @rtype: int
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def measureFeature(index):
+    """
+    Run a feature in a fresh worker process.
+
+    @param index: Index of the feature in `options.features`.
+    @return: Seconds needed, characters output and growth of peak memory in
+             bytes.
+    @rtype: ( float, int, int, )
+    """
+    ( name, feature, ) = options.features[index]
+    sink = CountingSink()
+    formatter = createFormatter(sink)
+    rss = _maxRss()
+    start = time.time()
+    feature(formatter, options.operations, options.depth)
+    formatter.endContent()
+    seconds = max(time.time() - start, 1e-6)
+    return ( seconds, sink.size, _maxRss() - rss, )
+
+def benchmarkFeatures():
+    """
+    Run every feature selected and report operations per second and peak
+    memory.
+    """
+    sys.stdout.write("%-14s %10s %10s %12s %10s %10s\n"
+                     % ( "feature", "operations", "seconds", "ops/s", "MB out",
+                         "MB peak", ))
+    # Every feature runs in a process of its own forked from this one so
+    # the peak memory of one feature doesn't hide that of the next
+    pool = multiprocessing.Pool(1, maxtasksperchild=1)
+    try:
+        for ( index, ( name, feature, ), ) in enumerate(options.features):
+            ( seconds, size,
+              peak, ) = pool.apply(measureFeature, ( index, ))
+            sys.stdout.write("%-14s %10d %10.3f %12.0f %10.2f %10.2f\n"
+                             % ( name, options.operations, seconds,
+                                 options.operations / seconds,
+                                 size / 1024.0 / 1024, peak / 1024.0 / 1024, ))
+            sys.stdout.flush()
+    finally:
+        pool.terminate()
+
+def benchmarkScaling():
+    """
+    Render every shape in every size and report the time needed.
+    """
+    sys.stdout.write("%-14s %12s %10s %10s\n"
+                     % ( "shape", "size", "seconds", "MB/s", ))
+    for ( name, shape, ) in shapes:
+        for size in options.sizes:
+            formatter = createFormatter(CountingSink())
+            start = time.time()
+            shape(formatter, size)
+            formatter.endContent()
+            seconds = max(time.time() - start, 1e-6)
+            sys.stdout.write("%-14s %12d %10.3f %10.2f\n"
+                             % ( name, size, seconds,
+                                 size / seconds / 1024 / 1024, ))
+            sys.stdout.flush()
+
+def checkReset():
+    """
+    Check that a formatter reset renders like a new one for every pair of
+    features.
+
+    @return: Number of pairs with differing output.
+    @rtype: int
+    """
+    failed = 0
+    for ( name, feature, ) in options.features:
+        sink = StringSink()
+        renderFeature(createFormatter(sink), feature)
+        expected = sink.getvalue()
+        for ( previousName, previous, ) in options.features:
+            formatter = createFormatter(StringSink())
+            renderFeature(formatter, previous)
+            sink = StringSink()
+            formatter.reset(page=FakePage(u"Bench/Page"), sink=sink)
+            renderFeature(formatter, feature)
+            if sink.getvalue() != expected:
+                sys.stdout.write("%s after %s: output differs from a new formatter\n"
+                                 % ( name, previousName, ))
+                failed += 1
+    sys.stdout.write("%d pairs checked, %d differ\n"
+                     % ( len(options.features) ** 2, failed, ))
+    return failed
+
+###############################################################################
+###############################################################################
+# Now work
+
+if __name__ == '__main__':
+    parseOptions()
+    Formatter = loadFormatter(options.formatter)
+    if options.check_reset:
+        sys.exit(checkReset() and 1)
+    elif options.benchmark == "features":
+        benchmarkFeatures()
+    else:
+        benchmarkScaling()
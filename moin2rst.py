@@ -8,12 +8,48 @@
 import sys
 import re
 import os
+import fnmatch
+import multiprocessing
+import hashlib
+import json
+import mmap
+import stat
+import signal
+import traceback
+import time
+import inspect
+import cProfile
+import SocketServer
+import threading
+import Queue
+import cStringIO
+import tarfile
+import zipfile
+import shutil
+import fcntl
+import resource
+import errno
 
 from optparse import OptionParser, OptionGroup
 
 from MoinMoin.request.request_cli import Request as RequestCLI
+from MoinMoin.request import RequestBase
+from MoinMoin.config import multiconfig
 from MoinMoin.Page import Page
+from MoinMoin.action import AttachFile
 from MoinMoin import wikiutil
+from MoinMoin import config
+from MoinMoin import i18n
+from MoinMoin import user
+from MoinMoin.logfile import editlog
+from MoinMoin.util.clock import Clock
+
+try:
+    import docutils.core
+    import docutils.nodes
+except ImportError:
+    # Only needed by -V/--validate
+    docutils = None
 
 ###############################################################################
 ###############################################################################
@@ -25,6 +61,104 @@ from MoinMoin import wikiutil
 """
 global options
 
+"""
+@var outputExtension: Extension of files written in bulk mode.
+@type outputExtension: str
+"""
+outputExtension = ".rst"
+
+"""
+@var worker: Request and formatter class used by parallel export workers. Set
+             before the workers are forked so they inherit the loaded
+             configuration.
+@type worker: ( MoinMoin.request.request_cli.Request, type, )
+"""
+worker = None
+
+"""
+@var spareFormatters: Formatters done with their page. `renderPage()` resets
+                      and reuses them instead of creating a formatter for
+                      every page.
+@type spareFormatters: [ Formatter, ... ]
+"""
+spareFormatters = [ ]
+
+"""
+@var manifestName: Name of the manifest file in the output directory.
+@type manifestName: str
+"""
+manifestName = ".moin2rst-manifest"
+
+"""
+@var validationName: Name of the file in the output directory caching the
+                     problems docutils found in outputs by their digest.
+@type validationName: str
+"""
+validationName = ".moin2rst-validation"
+
+"""
+@var checksumsName: Name of the file in the output directory listing every
+                    file exported with its checksum for -K/--checksums.
+@type checksumsName: str
+"""
+checksumsName = ".moin2rst-checksums"
+
+"""
+@var deltaName: Name of the file in the output directory listing the files
+                changed since the previous checksums were written.
+@type deltaName: str
+"""
+deltaName = ".moin2rst-delta"
+
+"""
+@var attachmentDirectory: Directory in the output directory attachments are
+                          exported to. Named like the other bookkeeping
+                          files so it never clashes with the output of a
+                          page.
+@type attachmentDirectory: str
+"""
+attachmentDirectory = ".moin2rst-attachments"
+
+"""
+@var contentDirectory: Directory in the output directory outputs are stored
+                       in by -C/--content-addressed. Named like
+                       `attachmentDirectory` for the same reason.
+@type contentDirectory: str
+"""
+contentDirectory = ".moin2rst-pages"
+
+"""
+@var exportedAttachments: Attachments exported by this process. Maps the
+                          path of an attachment to its size and
+                          modification time and the name of its copy so
+                          attachments referenced again are not hashed
+                          again.
+@type exportedAttachments: { str: ( ( int, float, ), str, ), ... }
+"""
+exportedAttachments = { }
+
+"""
+@var FICLONE: Linux ioctl to share the data of two files on file systems
+              supporting it.
+@type FICLONE: int
+"""
+FICLONE = 0x40049409
+
+"""
+@var retryBudgetFactor: Factor the budget given by -T/--timeout and
+                        -M/--memory is multiplied by for pages tried again
+                        after exceeding it.
+@type retryBudgetFactor: int
+"""
+retryBudgetFactor = 4
+
+"""
+@var budgetFactor: Factor the budget of the pages converted now is
+                   multiplied by.
+@type budgetFactor: int
+"""
+budgetFactor = 1
+
 ###############################################################################
 ###############################################################################
 # Functions
@@ -33,11 +167,13 @@ def parseOptions():
     """
     Sets options and returns arguments.
 
-    @return: Name of the input page.
-    @rtype: ( str, )
+    @return: Name of the input page or nothing in bulk mode.
+    @rtype: ( str, ) or ( )
     """
     global options
-    optionParser = OptionParser(usage="usage: %prog [option]... <page>",
+    optionParser = OptionParser(usage="""usage: %prog [option]... <page>
+       %prog [option]... -a|-m <regex>|-g <glob>|-l <file> -o <dir>
+       %prog [option]... -S <socket>""",
                                 description="""Convert a MoinMoin page to reStructuredText syntax.""")
 
     generalGroup = OptionGroup(optionParser, "General options")
@@ -61,8 +197,168 @@ expressions found in the variable "wikis" in the respective "farmconfig.py".
 to form a valid URL. If '%' is omitted it is assumed at the end.
 
 Defaults to the empty string.""")
+    generalGroup.add_option("-D", "--data-directory",
+                            default=None, dest="data_directory",
+                            help="""Read pages directly from the MoinMoin data directory "data-directory", for
+instance from a backup of a wiki. No request is set up so access control,
+users, themes and the underlay are ignored. The configuration given by
+-d/--directory is still needed for the parser. Otherwise the output is the
+same as when reading through the wiki except that pages are converted
+regardless of their ACLs and redirect pages are converted instead of
+failing.
+
+Defaults to reading pages through the wiki.""")
     optionParser.add_option_group(generalGroup)
 
+    bulkGroup = OptionGroup(optionParser, "Bulk options",
+                            """Giving any of -a/--all, -m/--match, -g/--glob or -l/--list converts many
+pages in one run. Configuration and formatter are loaded only once. No
+"page" argument may be given then.""")
+    bulkGroup.add_option("-a", "--all",
+                         default=False, action="store_true", dest="all",
+                         help="""Convert all pages of the wiki.""")
+    bulkGroup.add_option("-m", "--match",
+                         default=None, dest="match",
+                         help="""Convert only pages whose name is matched by the regular expression
+"match".""")
+    bulkGroup.add_option("-g", "--glob",
+                         default=None, dest="glob",
+                         help="""Convert only pages whose name is matched by the shell pattern "glob".""")
+    bulkGroup.add_option("-l", "--list",
+                         default=None, dest="list",
+                         help="""Convert the pages named in file "list", one per line. "-" reads the names from
+stdin. May be combined with -m/--match and -g/--glob to restrict the list
+further.""")
+    bulkGroup.add_option("-o", "--output-directory",
+                         default=None, dest="output_directory",
+                         help="""Directory to write converted pages to. Each page is written to a file named
+like the page with ".rst" appended. Subpages end up in subdirectories.
+
+Required in bulk mode unless -A/--archive is given.""")
+    bulkGroup.add_option("-A", "--archive",
+                         default=None, dest="archive",
+                         help="""Write all converted pages into the single file "archive" instead of an
+output directory. Pages are named inside like the files in the output
+directory. The format is chosen by the extension of "archive": ".tar",
+".tar.gz", ".tgz" or ".tar.bz2" for a tar archive written as a stream,
+".zip" for a zip archive and ".pack" for a pack. A pack is the plain
+concatenation of the converted pages. Its index "archive.index" maps each
+page name to the offset and length of the page in JSON. Pages exported to
+an existing pack are appended and replace older ones in the index. With
+-t/--attachments the attachments are added like to the output directory.
+Not allowed with -o/--output-directory and -i/--incremental.""")
+    bulkGroup.add_option("-j", "--jobs",
+                         default=1, type=int, dest="jobs",
+                         help="""Number of processes converting pages in parallel. The processes are forked
+after the configuration has been loaded. Largest pages are converted first.
+
+Defaults to 1.""")
+    bulkGroup.add_option("-i", "--incremental",
+                         default=False, action="store_true", dest="incremental",
+                         help="""Convert only pages which changed since the last run. Pages are skipped if
+their revision and the version of the formatter are the same as recorded in
+the manifest in the output directory and no page they include, no entry of
+the interwiki map they use and with -t/--attachments no attachment they
+reference changed. Files of deleted pages are removed.""")
+    bulkGroup.add_option("-t", "--attachments",
+                         default=False, action="store_true", dest="attachments",
+                         help="""Export the attachments referenced by the pages converted to the directory
+".moin2rst-attachments" in the output directory and link to the copies. Every
+content is stored only once named by its digest. Copies share the data with
+the original where the file system supports it. Copies no page refers to any
+more are removed. With -A/--archive the attachments are added to the
+archive.""")
+    bulkGroup.add_option("--link-attachments",
+                         default=False, action="store_true", dest="link_attachments",
+                         help="""Export attachments as hard links to the originals where possible instead of
+copying them. Changing an exported attachment then changes the wiki, too.""")
+    bulkGroup.add_option("-C", "--content-addressed",
+                         default=False, action="store_true", dest="content_addressed",
+                         help="""Store every distinct output only once in the directory ".moin2rst-pages" in
+the output directory in a file named by its digest. The file of a page
+becomes a relative symbolic link to it so identical outputs are written and
+transferred only once and consumers may compare the link targets instead of
+the content.
+Outputs no longer referenced are removed. Not allowed with -A/--archive.""")
+    bulkGroup.add_option("-K", "--checksums",
+                         default=False, action="store_true", dest="checksums",
+                         help="""Write ".moin2rst-checksums" to the output directory listing every page,
+attachment and stored output with its size, digest, modification time and for
+pages the revision. Write ".moin2rst-delta" listing the files added, changed
+and removed since the checksums were written the last time and the digests of
+both checksum files. Consumers syncing the output then fetch only the files
+listed instead of comparing the whole tree. Not allowed with -A/--archive.""")
+    bulkGroup.add_option("-p", "--pipeline",
+                         default=0, type=int, dest="pipeline",
+                         help="""Overlap reading, converting and writing pages. A thread reads up to
+"pipeline" pages ahead of the conversion and another thread writes up to
+"pipeline" converted pages behind it so slow disks and CPU are kept busy at
+the same time. Converted pages are held in memory until written.
+
+Defaults to 0 which reads, converts and writes one page after the other.""")
+    bulkGroup.add_option("-T", "--timeout",
+                         default=None, type=float, dest="timeout",
+                         help="""Abort converting a page after "timeout" seconds. Pages aborted are tried
+again one after the other when all other pages are done with four times the
+budget and fail if they exceed that, too.
+
+Defaults to no limit.""")
+    bulkGroup.add_option("-M", "--memory",
+                         default=None, type=int, dest="memory",
+                         help="""Abort converting a page when the process converting it grows by more than
+"memory" megabytes. Pages aborted are tried again like for -T/--timeout.
+The limit applies to the address space of the whole process so memory
+taken by other threads counts, too. Therefore not allowed with
+-p/--pipeline. This is best effort only: Running out of memory inside
+MoinMoin is often caught by MoinMoin itself and the page is converted
+incompletely or fails with another error.
+
+Defaults to no limit.""")
+    bulkGroup.add_option("-F", "--failures",
+                         default=None, dest="failures",
+                         help="""Write a report on the pages which failed to the file "failures" as JSON. It
+gives for every page the error, the size of the page, the seconds spent
+converting it and whether it exceeded its budget.""")
+    bulkGroup.add_option("-V", "--validate",
+                         default=None, dest="validate",
+                         help="""Parse the converted pages with docutils after the conversion and write the
+warnings and errors found to the file "validate" as JSON. Pages are parsed by
+-j/--jobs processes. Results are cached in the output directory by the
+digest of the output so unchanged output is not parsed again. Links to other
+pages are resolved outside of a page and are not reported. Not allowed with
+-A/--archive.""")
+    optionParser.add_option_group(bulkGroup)
+
+    serverGroup = OptionGroup(optionParser, "Server options",
+                              """A server keeps configuration and formatter loaded and converts pages for
+clients. The client "moin2rstc.py" takes the same options and arguments as
+this script and connects to the socket named in the environment variable
+MOIN2RST_SOCKET. -d/--directory and -D/--data-directory of the server are
+used for all clients.""")
+    serverGroup.add_option("-S", "--serve",
+                           default=None, dest="serve",
+                           help="""Run as a server listening on the Unix socket "serve". Every client is served
+by a process forked from the server so clients are served in parallel. No
+"page" argument may be given then.""")
+    optionParser.add_option_group(serverGroup)
+
+    profileGroup = OptionGroup(optionParser, "Profiling options")
+    profileGroup.add_option("-P", "--profile",
+                            default=None, dest="profile",
+                            help="""Record for every method of the formatter and every page the number of calls,
+the cumulative time, the time spent in the method itself and the bytes
+output. The records are written to the file "profile" as JSON.""")
+    profileGroup.add_option("--profile-stats",
+                            default=None, dest="profile_stats",
+                            help="""Profile the whole conversion with cProfile and write the statistics to the
+file "profile-stats" for use with the "pstats" module. Not supported with
+-j/--jobs.""")
+    profileGroup.add_option("--timings",
+                            default=None, dest="timings",
+                            help="""Write the seconds spent converting every page to the file "timings" as JSON.
+Unlike -P/--profile this hardly slows down the conversion.""")
+    optionParser.add_option_group(profileGroup)
+
     argumentGroup = OptionGroup(optionParser, "Arguments")
     optionParser.add_option_group(argumentGroup)
     argument1Group = OptionGroup(optionParser, "page", """The page named "page" is used as input. Output is to stdout.""")
@@ -70,8 +366,80 @@ Defaults to the empty string.""")
 
     ( options, args, ) = optionParser.parse_args()
 
-    if len(args) != 1:
+    options.bulk = bool(options.all or options.match or options.glob
+                        or options.list)
+    if options.serve:
+        if args or options.bulk:
+            optionParser.error("No argument or bulk option allowed with -S/--serve")
+        options.serve = os.path.abspath(options.serve)
+    elif options.bulk:
+        if args:
+            optionParser.error("No argument allowed in bulk mode")
+        if options.archive:
+            if options.output_directory:
+                optionParser.error("-o/--output-directory not allowed with -A/--archive")
+            if options.incremental:
+                optionParser.error("-i/--incremental not allowed with -A/--archive")
+            if options.validate:
+                optionParser.error("-V/--validate not allowed with -A/--archive")
+            if options.content_addressed:
+                optionParser.error("-C/--content-addressed not allowed with -A/--archive")
+            if options.checksums:
+                optionParser.error("-K/--checksums not allowed with -A/--archive")
+            if archiveClass(options.archive) is None:
+                optionParser.error("-A/--archive: Unknown format of %r"
+                                   % ( options.archive, ))
+            options.archive = os.path.abspath(options.archive)
+        elif not options.output_directory:
+            optionParser.error("-o/--output-directory required in bulk mode")
+        else:
+            options.output_directory = os.path.abspath(options.output_directory)
+        if options.revision:
+            optionParser.error("-r/--revision not allowed in bulk mode")
+        if options.jobs < 1:
+            optionParser.error("-j/--jobs must be at least 1")
+        if options.pipeline < 0:
+            optionParser.error("-p/--pipeline must not be negative")
+        if options.timeout is not None and options.timeout <= 0:
+            optionParser.error("-T/--timeout must be positive")
+        if options.memory is not None and options.memory <= 0:
+            optionParser.error("-M/--memory must be positive")
+        if options.memory and options.pipeline:
+            # The reading and writing threads share the address space
+            optionParser.error("-M/--memory not allowed with -p/--pipeline")
+        if options.failures:
+            options.failures = os.path.abspath(options.failures)
+        if options.validate:
+            if docutils is None:
+                optionParser.error("-V/--validate requires docutils")
+            options.validate = os.path.abspath(options.validate)
+        # Relative paths must survive the change to the wiki directory
+        if options.list and options.list != "-":
+            options.list = os.path.abspath(options.list)
+        if options.match:
+            try:
+                options.match = re.compile(options.match.decode(config.charset),
+                                           re.UNICODE)
+            except re.error, e:
+                optionParser.error("-m/--match: %s" % ( e, ))
+    elif len(args) != 1:
         optionParser.error("Exactly one argument required")
+    elif options.validate:
+        optionParser.error("-V/--validate only allowed in bulk mode")
+    if options.data_directory:
+        options.data_directory = os.path.abspath(options.data_directory)
+        if not os.path.isdir(os.path.join(options.data_directory, "pages")):
+            optionParser.error("-D/--data-directory: No pages in %r"
+                               % ( options.data_directory, ))
+
+    if options.profile:
+        options.profile = os.path.abspath(options.profile)
+    if options.profile_stats:
+        if options.bulk and options.jobs > 1:
+            optionParser.error("--profile-stats not allowed with -j/--jobs")
+        options.profile_stats = os.path.abspath(options.profile_stats)
+    if options.timings:
+        options.timings = os.path.abspath(options.timings)
 
     percents = re.findall("%", options.url_template)
     if len(percents) == 0:
@@ -83,31 +451,2032 @@ Defaults to the empty string.""")
 
     return args
 
+###############################################################################
+
+def createRequest(pageName):
+    """
+    Create the request used for rendering.
+
+    @param pageName: Name of the page requested. Empty in bulk mode.
+    @type pageName: str
+    @rtype: MoinMoin.request.request_cli.Request or RawRequest
+    """
+    url = re.sub("%", re.escape(pageName), options.url_template)
+    if not url:
+        # An empty URL matches no configuration at all
+        url = "CLI"
+    if options.data_directory:
+        return RawRequest(multiconfig.getConfig(url), options.data_directory)
+    return RequestCLI(url=url, pagename=pageName)
+
+def openPage(request, pageName, revision=None, formatter=None):
+    """
+    @param revision: Revision to open or ``None`` for the current one.
+    @return: The page named `pageName` read through the wiki or directly
+             from the data directory.
+    @rtype: MoinMoin.Page.Page or RawPage
+    """
+    if options.data_directory:
+        return RawPage(request, pageName, revision, formatter)
+    return Page(request, pageName, rev=revision, formatter=formatter)
+
+def loadFormatter(request):
+    """
+    @return: The class of the reStructuredText formatter plugin.
+    """
+    return wikiutil.importPlugin(request.cfg, "formatter",
+                                 "text_x-rst", "Formatter")
+
+###############################################################################
+
+class PageOutput(object):
+    """
+    Receives everything written to a request while a page is rendered.
+    """
+
+    def __init__(self, request, file, profile=None):
+        """
+        @param file: File the encoded output is written to.
+        @param profile: Profile the output is accounted to or ``None``.
+        @type profile: MethodProfile
+        """
+        self._request = request
+        self._file = file
+        self._profile = profile
+        """
+        Digest of the output written so far.
+        """
+        self.digest = hashlib.md5()
+
+    def write(self, *data):
+        data = self._request.encode(data)
+        self.digest.update(data)
+        self._file.write(data)
+        if self._profile is not None:
+            self._profile.output(len(data))
+
+class RawRequest(object):
+    """
+    Stands in for a MoinMoin request when pages are read directly from a
+    data directory. Provides only what the parser and the formatter need.
+    """
+
+    def __init__(self, cfg, dataDirectory):
+        """
+        @param cfg: Configuration of the wiki.
+        @param dataDirectory: Data directory to read pages from.
+        @type dataDirectory: str
+        """
+        self.cfg = cfg
+        self.dataDirectory = dataDirectory
+        # Pages opened by MoinMoin itself, for instance to check whether a
+        # link target exists, are looked up in the data directory, too
+        cfg.data_dir = dataDirectory
+        if i18n.languages is None:
+            # Normally loaded by the request; no translations are used here
+            i18n.languages = { }
+        self.form = { }
+        self.writestack = [ ]
+        self.pragma = { }
+        self.script_name = "."
+        self.include_id = None
+        self.lang = cfg.language_default
+        self.current_lang = self.content_lang = self.lang
+        self.clock = Clock()
+        # Anonymous with the default preferences of the wiki
+        self.user = user.User(self)
+        self.user.may = RawPermissions()
+        self.editlog = editlog.EditLog(self,
+                                       filename=os.path.join(dataDirectory,
+                                                             "edit-log"))
+        self._loadInterwikiMap()
+
+    encode = RequestBase.encode.im_func
+    getScriptname = RequestBase.getScriptname.im_func
+    normalizePagename = RequestBase.normalizePagename.im_func
+    redirect = RequestBase.redirect.im_func
+    getPragma = RequestBase.getPragma.im_func
+    setPragma = RequestBase.setPragma.im_func
+
+    def getText(self, text, **kw):
+        if kw.get("wiki"):
+            # Untranslated but with the markup rendered as HTML like by a
+            # request
+            return i18n.getText(text, self, self.lang, **kw)
+        return text
+
+    def write(self, *data):
+        raise RuntimeError("No output set up")
+
+    def reset(self):
+        self.pragma = { }
+
+    def _loadInterwikiMap(self):
+        """
+        Fill the cache of the interwiki map like `wikiutil.load_wikimap()`
+        does but with the map page read from the data directory. The cache
+        is never refreshed.
+        """
+        wikiutil.generate_file_list(self)
+        lines = [ ]
+        for filename in self.cfg.shared_intermap_files:
+            file = open(filename)
+            try:
+                lines.extend(file.read().decode(config.charset).splitlines())
+            finally:
+                file.close()
+        page = RawPage(self, wikiutil.INTERWIKI_PAGE)
+        if page.exists():
+            lines.extend(page.get_raw_body().splitlines())
+
+        interwikiList = { }
+        for line in lines:
+            if not line or line[0] == "#":
+                continue
+            fields = line.split(None, 2)
+            if len(fields) >= 2:
+                interwikiList[fields[0]] = fields[1]
+        interwikiList["Self"] = self.getScriptname() + "/"
+        if self.cfg.interwikiname:
+            interwikiList[self.cfg.interwikiname] = self.getScriptname() + "/"
+
+        self.cfg.cache.interwiki_list = interwikiList
+        self.cfg.cache.interwiki_mtime = 0
+        self.cfg.cache.interwiki_ts = sys.maxint
+
+class RawPermissions(object):
+    """
+    Stands in for the permissions of the user of a `RawRequest`. Access
+    control is not checked when pages are read directly from a data
+    directory so every right is granted.
+    """
+
+    def __getattr__(self, right):
+        return lambda pageName: True
+
+class RawPage(object):
+    """
+    A page read directly from the data directory of a wiki. Provides what
+    `renderPage()` and the formatter use of a `MoinMoin.Page.Page`.
+    """
+
+    def __init__(self, request, page_name, revision=None, formatter=None):
+        """
+        @param revision: Revision to read or ``None`` for the current one.
+        """
+        self.request = request
+        self.page_name = page_name
+        self.formatter = formatter
+        self.hilite_re = None
+        self._path = os.path.join(request.dataDirectory, "pages",
+                                  wikiutil.quoteWikinameFS(page_name))
+        self.rev = revision
+        self._body = None
+
+    def current_rev(self):
+        """
+        @return: Number of the current revision or ``0`` if there is none.
+        @rtype: int
+        """
+        try:
+            file = open(os.path.join(self._path, "current"))
+        except IOError:
+            return 0
+        try:
+            try:
+                return int(file.read().strip())
+            except ValueError:
+                return 0
+        finally:
+            file.close()
+
+    def get_real_rev(self):
+        """
+        @return: Number of the revision read.
+        @rtype: int
+        """
+        return self.rev or self.current_rev()
+
+    def _revisionPath(self):
+        return os.path.join(self._path, "revisions",
+                            "%08d" % ( self.rev or self.current_rev(), ))
+
+    def exists(self):
+        # Deleted pages have a current revision without a file
+        return os.path.exists(self._revisionPath())
+
+    def size(self):
+        try:
+            return os.path.getsize(self._revisionPath())
+        except OSError:
+            return 0
+
+    def getPagePath(self, *args, **keywords):
+        """
+        @return: Path of the directory of the page or of `args` joined to it.
+                 Unlike `MoinMoin.Page.Page.getPagePath()` nothing is
+                 created in the data directory.
+        @rtype: str
+        """
+        return os.path.join(self._path, *args)
+
+    def get_raw_body_str(self):
+        return self.get_raw_body().encode(config.charset)
+
+    def get_raw_body(self):
+        """
+        @return: Text of the revision with line ends normalized.
+        @rtype: unicode
+        """
+        if self._body is None:
+            file = open(self._revisionPath(), "rb")
+            try:
+                if os.fstat(file.fileno()).st_size:
+                    # Decode right from the mapping saving a copy of the raw
+                    # text
+                    mapping = mmap.mmap(file.fileno(), 0,
+                                        access=mmap.ACCESS_READ)
+                    try:
+                        self._body = unicode(mapping, config.charset)
+                    finally:
+                        mapping.close()
+                else:
+                    self._body = u""
+            finally:
+                file.close()
+            self._body = self._body.replace(u"\r", u"")
+        return self._body
+
+    def set_raw_body(self, body, modified=0):
+        self._body = body
+
+    def getPageHeader(self):
+        ( meta, data, ) = wikiutil.get_processing_instructions(self.get_raw_body())
+        return "\n".join([ "#%s %s" % ( verb, args, )
+                            for ( verb, args, ) in meta ])
+
+    def send_page(self, **keywords):
+        """
+        Render the page like `MoinMoin.Page.Page.send_page()` does for a
+        formatter other than the HTML formatter. Redirects are not followed
+        and ACLs are not checked.
+        """
+        request = self.request
+        ( meta, data, ) = wikiutil.get_processing_instructions(self.get_raw_body())
+        format = request.cfg.default_markup or "wiki"
+        formatArgs = ""
+        if self.get_raw_body().startswith(u"<?xml"):
+            format = "xslt"
+            meta = [ ]
+        for ( verb, args, ) in meta:
+            if verb == "format":
+                ( format, formatArgs, ) = (args + " ").split(" ", 1)
+                format = format.lower()
+                formatArgs = formatArgs.strip()
+        Parser = wikiutil.searchAndImportPlugin(request.cfg, "parser", format)
+        parser = Parser(data, request, format_args=formatArgs,
+                        start_line=len(meta))
+
+        request.formatter = self.formatter
+        request.page = self
+        self.formatter.setPage(self)
+        request.write(self.formatter.startDocument(self.page_name))
+        request.write(self.formatter.startContent("content"))
+        parser.format(self.formatter)
+        request.write(self.formatter.endContent())
+        request.write(self.formatter.endDocument())
+
+def rawPageNames(request):
+    """
+    @return: Names of all existing pages in the data directory.
+    @rtype: [ unicode, ... ]
+    """
+    result = [ ]
+    for name in os.listdir(os.path.join(request.dataDirectory, "pages")):
+        try:
+            pageName = wikiutil.unquoteWikiname(name)
+        except Exception:
+            # Not a page directory
+            continue
+        if RawPage(request, pageName).exists():
+            result.append(pageName)
+    return result
+
+###############################################################################
+
+def renderPage(request, Formatter, pageName, file, revision=None, body=None):
+    """
+    Render a page using `request` and write the result to `file`.
+
+    @param Formatter: Formatter class as returned by `loadFormatter()` or
+                      `profiledFormatter()`.
+    @param revision: Revision to render or ``None`` for the current one.
+    @param body: Text of the page read in advance or ``None`` to read it
+                 now.
+    @type body: unicode
+    @return: The rendered page, the digest of the output and the profile of
+             the formatter methods as returned by `MethodProfile.report()`
+             or ``None`` if not profiling. With only --timings the profile
+             gives just the seconds spent. The formatter of the page is
+             reused for the next page rendered.
+    @rtype: ( MoinMoin.Page.Page, str, { str: object, ... }, )
+    """
+    start = time.time()
+    profile = None
+    if options.profile:
+        profile = MethodProfile()
+    output = PageOutput(request, file, profile)
+
+    attachmentUrl = None
+    if options.bulk and options.attachments:
+        def attachmentUrl(attachedTo, fileName):
+            return exportAttachment(request, pageName, attachedTo, fileName)
+
+    # Final output is written by the formatter as soon as possible so big
+    # pages are not held in memory
+    formatter = acquireFormatter(request, Formatter, output, attachmentUrl)
+    if profile is not None:
+        formatter._methodProfile = profile
+    request.formatter = formatter
+
+    try:
+        page = openPage(request, pageName, revision, formatter)
+        if not page.exists():
+            raise RuntimeError("No page named %r" % ( pageName, ))
+        if body is not None:
+            page.set_raw_body(body)
+
+        # Clear state left over from the previous page
+        request.reset()
+        # Set by the action handling of a web request and used by some
+        # parsers
+        request.page = page
+        request.redirect(output)
+        limit = startBudget()
+        try:
+            try:
+                # Headers are of no use here and may be emitted only once per
+                # request
+                page.send_page(emit_headers=0)
+            except ( MemoryError, EnvironmentError, ), e:
+                if (limit is None
+                    or (isinstance(e, EnvironmentError)
+                        and e.errno != errno.ENOMEM)):
+                    raise
+                raise BudgetExceeded("memory budget of %d MB exceeded"
+                                     % ( options.memory * budgetFactor, ))
+        finally:
+            stopBudget(limit)
+            request.redirect()
+    finally:
+        spareFormatters.append(formatter)
+    report = None
+    if profile is not None:
+        report = profile.report()
+    elif options.timings:
+        report = { "seconds": time.time() - start, }
+    return ( page, output.digest.hexdigest(), report, )
+
+def acquireFormatter(request, Formatter, sink, attachmentUrl):
+    """
+    @return: A formatter of class `Formatter` for `request`. A spare one is
+             reset and used if available.
+    @rtype: Formatter
+    """
+    while spareFormatters:
+        formatter = spareFormatters.pop()
+        if formatter.__class__ is Formatter and formatter.request is request:
+            formatter.reset(sink=sink, attachmentUrl=attachmentUrl)
+            return formatter
+    return Formatter(request, sink=sink, attachmentUrl=attachmentUrl)
+
+###############################################################################
+
+class BudgetExceeded(BaseException):
+    """
+    Raised when converting a page takes longer or grows the process more
+    than allowed by -T/--timeout or -M/--memory. Like `KeyboardInterrupt`
+    it is no `Exception` so neither the parser nor the formatter take it
+    for an error of the page and carry on.
+    """
+
+def _timeoutExpired(signum, frame):
+    raise BudgetExceeded("timeout of %g seconds exceeded"
+                         % ( options.timeout * budgetFactor, ))
+
+def addressSpace():
+    """
+    @return: Size of the address space of this process in bytes.
+    @rtype: int
+    """
+    file = open("/proc/self/statm")
+    try:
+        return int(file.read().split()[0]) * mmap.PAGESIZE
+    finally:
+        file.close()
+
+def startBudget():
+    """
+    Start watching the budget for converting a page in bulk mode. Must be
+    called in the main thread.
+
+    @return: Limit of the address space to be restored by `stopBudget()` or
+             ``None`` if the memory is not limited.
+    @rtype: ( int, int, )
+    """
+    if not options.bulk:
+        return None
+    if options.timeout:
+        signal.signal(signal.SIGALRM, _timeoutExpired)
+        signal.setitimer(signal.ITIMER_REAL, options.timeout * budgetFactor)
+    limit = None
+    if options.memory:
+        limit = resource.getrlimit(resource.RLIMIT_AS)
+        ( soft, hard, ) = limit
+        soft = addressSpace() + options.memory * budgetFactor * 1024 * 1024
+        if hard != resource.RLIM_INFINITY:
+            soft = min(soft, hard)
+        resource.setrlimit(resource.RLIMIT_AS, ( soft, hard, ))
+    return limit
+
+def stopBudget(limit):
+    """
+    Stop watching the budget started by `startBudget()`.
+    """
+    if options.bulk and options.timeout:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+    if limit is not None:
+        resource.setrlimit(resource.RLIMIT_AS, limit)
+
+def failure(error, seconds=None, size=None):
+    """
+    @param error: Exception converting or storing a page.
+    @param seconds: Seconds spent converting the page or ``None``.
+    @param size: Size of the page or ``None``.
+    @return: Report on a page which failed.
+    @rtype: { str: object, ... }
+    """
+    if seconds is not None:
+        seconds = round(seconds, 3)
+    message = error.__class__.__name__
+    if errorMessage(error):
+        message = u"%s: %s" % ( message, errorMessage(error), )
+    return { "error": message,
+             "seconds": seconds,
+             "size": size,
+             "exceeded": isinstance(error, BudgetExceeded), }
+
+def errorMessage(error):
+    """
+    @return: Message of the exception `error`. Unlike ``str(error)`` this
+             does not fail for messages which are not ASCII.
+    @rtype: unicode
+    """
+    try:
+        return unicode(error)
+    except UnicodeError:
+        # A message of encoded bytes
+        return str(error).decode(config.charset, "replace")
+
+def pageFailure(request, pageName, error, start):
+    """
+    @param start: Time converting the page started.
+    @return: Report on a page which failed to convert.
+    @rtype: { str: object, ... }
+    """
+    seconds = time.time() - start
+    try:
+        size = openPage(request, pageName).size()
+    except Exception:
+        size = None
+    return failure(error, seconds, size)
+
+###############################################################################
+
+def selectPages(request):
+    """
+    @return: Sorted names of the pages selected by the bulk options.
+    @rtype: [ unicode, ... ]
+    """
+    if options.list:
+        if options.list == "-":
+            listFile = sys.stdin
+        else:
+            listFile = open(options.list)
+        pageNames = set([ request.normalizePagename(line.decode(config.charset))
+                          for line in listFile ])
+        pageNames.discard(u"")
+    elif options.data_directory:
+        pageNames = rawPageNames(request)
+    else:
+        pageNames = request.rootpage.getPageList(user="")
+
+    if options.match:
+        pageNames = [ pageName
+                      for pageName in pageNames
+                      if options.match.search(pageName) ]
+    if options.glob:
+        pageNames = fnmatch.filter(pageNames,
+                                   options.glob.decode(config.charset))
+    return sorted(pageNames)
+
+def outputName(pageName):
+    """
+    @return: Path of the file `pageName` is written to in bulk mode relative
+             to the output directory or the archive.
+    @rtype: str
+    """
+    return pageName.encode(config.charset) + outputExtension
+
+def outputPath(pageName):
+    """
+    @return: Path of the file `pageName` is written to in bulk mode.
+    @rtype: str
+    """
+    return os.path.join(options.output_directory,
+                        *outputName(pageName).split("/"))
+
+def makeOutputDirectory(path):
+    """
+    Create the directory the file `path` is written to if needed.
+    """
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # May have been created by a parallel worker meanwhile
+            if not os.path.isdir(directory):
+                raise
+
+def manifestEntry(Formatter, page, outputDigest):
+    """
+    @return: Manifest entry for `page` rendered with an output digest of
+             `outputDigest`. Pages included by the rendering and entries of
+             the interwiki map used by it are recorded when there are any.
+             Attachments referenced are recorded when exporting them.
+    @rtype: { str: object, ... }
+    """
+    entry = { "revision": page.current_rev(),
+              "source": hashlib.md5(page.get_raw_body_str()).hexdigest(),
+              "output": outputDigest,
+              "formatter": Formatter.version, }
+    if page.formatter.includedPages:
+        entry["includes"] = page.formatter.includedPages
+    if page.formatter.interwikiNames:
+        entry["interwiki"] = page.formatter.interwikiNames
+    if options.bulk and options.attachments:
+        entry["attachments"] = dict([
+            ( u"%s/%s" % ( attachedTo, fileName, ),
+              attachmentState(page.request, attachedTo, fileName), )
+            for ( attachedTo, fileName, ) in page.formatter.attachments ])
+    return entry
+
+def attachmentState(request, attachedTo, fileName):
+    """
+    @return: Size and modification time of an attachment when it was
+             exported and the name of its copy or ``None`` if there was no
+             such attachment.
+    @rtype: [ int, float, str, ]
+    """
+    exported = exportedAttachments.get(attachmentPath(request, attachedTo,
+                                                      fileName))
+    if exported is None:
+        return None
+    ( ( size, mtime, ), name, ) = exported
+    return [ size, mtime, name, ]
+
+def attachmentChanged(request, key, state):
+    """
+    @param key: Page name and file name of an attachment joined by a slash as
+                recorded in a manifest entry.
+    @param state: State of the attachment as returned by `attachmentState()`
+                  when the page was exported.
+    @return: Whether the attachment was added, changed or removed since or
+             its copy is gone.
+    @rtype: bool
+    """
+    ( attachedTo, fileName, ) = key.rsplit(u"/", 1)
+    try:
+        status = os.stat(attachmentPath(request, attachedTo, fileName))
+    except OSError:
+        status = None
+    if status is None or not stat.S_ISREG(status.st_mode):
+        return state is not None
+    return (state is None
+            or [ status.st_size, status.st_mtime, ] != state[:2]
+            or not os.path.exists(os.path.join(options.output_directory,
+                                               attachmentDirectory,
+                                               state[2])))
+
+def attachmentPath(request, pageName, fileName):
+    """
+    @return: Path of the attachment `fileName` of the page `pageName`.
+    @rtype: str
+    """
+    if options.data_directory:
+        directory = os.path.join(request.dataDirectory, "pages",
+                                 wikiutil.quoteWikinameFS(pageName),
+                                 "attachments")
+    else:
+        directory = AttachFile.getAttachDir(request, pageName)
+    return os.path.join(directory, fileName.encode(config.charset))
+
+def fileDigest(path):
+    """
+    @return: Digest of the content of the file `path`.
+    @rtype: str
+    """
+    digest = hashlib.md5()
+    file = open(path, "rb")
+    try:
+        for data in iter(lambda: file.read(1 << 20), ""):
+            digest.update(data)
+    finally:
+        file.close()
+    return digest.hexdigest()
+
+def copyFile(source, target):
+    """
+    Copy the file `source` to `target` sharing the data where possible.
+    """
+    if options.link_attachments:
+        try:
+            os.link(source, target)
+            return
+        except OSError:
+            # Different file systems or no hard links supported
+            pass
+    sourceFile = open(source, "rb")
+    try:
+        targetFile = open(target, "wb")
+        try:
+            try:
+                # Reflink on file systems with copy on write
+                fcntl.ioctl(targetFile.fileno(), FICLONE, sourceFile.fileno())
+            except EnvironmentError:
+                shutil.copyfileobj(sourceFile, targetFile, 1 << 20)
+        finally:
+            targetFile.close()
+    finally:
+        sourceFile.close()
+
+_reExtension = re.compile(r"^\.\w+$")
+
+def exportAttachment(request, pageName, attachedTo, fileName):
+    """
+    Export an attachment to the output directory unless its content has
+    been exported already. With -A/--archive only the name of the copy is
+    determined. The attachment is added to the archive by
+    `archiveAttachments()`.
+
+    @param pageName: Name of the page referencing the attachment.
+    @param attachedTo: Name of the page the attachment belongs to.
+    @return: URL of the copy relative to the output of `pageName` or
+             ``None`` if there is no such attachment.
+    @rtype: unicode
+    """
+    source = attachmentPath(request, attachedTo, fileName)
+    try:
+        status = os.stat(source)
+    except OSError:
+        return None
+    if not stat.S_ISREG(status.st_mode):
+        return None
+    key = ( status.st_size, status.st_mtime, )
+    exported = exportedAttachments.get(source)
+    if exported is not None and exported[0] == key:
+        name = exported[1]
+    else:
+        extension = os.path.splitext(fileName)[1].lower()
+        if not _reExtension.search(extension):
+            extension = u""
+        name = fileDigest(source) + extension.encode(config.charset)
+        target = os.path.join(options.output_directory or "",
+                              attachmentDirectory, name)
+        if not options.archive and not os.path.exists(target):
+            makeOutputDirectory(target)
+            # Parallel workers may export the same content meanwhile
+            temporaryPath = "%s.%d.tmp" % ( target, os.getpid(), )
+            copyFile(source, temporaryPath)
+            os.rename(temporaryPath, target)
+        exportedAttachments[source] = ( key, name, )
+    # Relative to the output directory or the root of the archive
+    url = os.path.relpath(os.path.join(attachmentDirectory, name),
+                          os.path.dirname(outputName(pageName)) or os.curdir)
+    return url.replace(os.sep, "/").decode(config.charset)
+
+def exportPage(request, Formatter, pageName):
+    """
+    Render a page to its file in the output directory.
+
+    @return: Manifest entry for the page and profile of the formatter
+             methods or ``None``.
+    @rtype: ( { str: object, ... }, { str: object, ... }, )
+    """
+    path = outputPath(pageName)
+    # Write to a temporary file so a failed page leaves no partial output.
+    # It is placed in the output directory itself so the directory of a
+    # subpage is created only for a page converted successfully.
+    temporaryPath = os.path.join(options.output_directory,
+                                 ".page.%d.tmp" % ( os.getpid(), ))
+    makeOutputDirectory(temporaryPath)
+    file = open(temporaryPath, "wb")
+    try:
+        try:
+            ( page, outputDigest,
+              profile, ) = renderPage(request, Formatter, pageName, file)
+        finally:
+            file.close()
+    except:
+        os.remove(temporaryPath)
+        raise
+    makeOutputDirectory(path)
+    if options.content_addressed:
+        storeContent(pageName, temporaryPath, outputDigest)
+    else:
+        os.rename(temporaryPath, path)
+    return ( manifestEntry(Formatter, page, outputDigest), profile, )
+
+def contentPath(digest):
+    """
+    @return: Path of the output with `digest` stored by
+             -C/--content-addressed.
+    @rtype: str
+    """
+    return os.path.join(options.output_directory, contentDirectory, digest)
+
+def storeContent(pageName, temporaryPath, digest):
+    """
+    Move the output of a page to the content store unless the same output is
+    stored already and link the file of the page to it.
+
+    @param temporaryPath: File the output was written to. Gone afterwards.
+    @param digest: Digest of the output.
+    """
+    target = contentPath(digest)
+    if os.path.exists(target):
+        os.remove(temporaryPath)
+    else:
+        makeOutputDirectory(target)
+        # Parallel workers may store the same output meanwhile which is
+        # harmless
+        os.rename(temporaryPath, target)
+    path = outputPath(pageName)
+    link = os.path.relpath(target, os.path.dirname(path))
+    try:
+        if os.readlink(path) == link:
+            # Unchanged links keep their time so syncing skips them
+            return
+    except OSError:
+        pass
+    temporaryLink = path + ".tmp"
+    os.symlink(link, temporaryLink)
+    os.rename(temporaryLink, path)
+
+def removeUnreferencedContent(manifest):
+    """
+    Remove the outputs in the content store no page refers to.
+
+    @param manifest: Manifest of this run.
+    @return: Number of outputs stored and number of outputs removed.
+    @rtype: ( int, int, )
+    """
+    return removeUnreferencedFiles(contentDirectory,
+                                   [ entry["output"]
+                                     for entry in manifest.values() ])
+
+def removeUnreferencedAttachments(manifest):
+    """
+    Remove the copies of attachments no page refers to.
+
+    @param manifest: Manifest of this run.
+    @return: Number of copies kept and number of copies removed.
+    @rtype: ( int, int, )
+    """
+    return removeUnreferencedFiles(attachmentDirectory,
+                                   [ state[2]
+                                     for entry in manifest.values()
+                                     for state in entry.get("attachments",
+                                                            { }).values()
+                                     if state is not None ])
+
+def removeUnreferencedFiles(directory, referenced):
+    """
+    Remove the files in `directory` of the output directory not named in
+    `referenced`.
+
+    @return: Number of files kept and number of files removed.
+    @rtype: ( int, int, )
+    """
+    referenced = set(referenced)
+    directory = os.path.join(options.output_directory, directory)
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        names = [ ]
+    kept = removed = 0
+    for name in names:
+        path = os.path.join(directory, name)
+        mode = os.lstat(path).st_mode
+        if not (stat.S_ISREG(mode) or stat.S_ISLNK(mode)):
+            # Not put there by this script
+            continue
+        if name in referenced:
+            kept += 1
+        else:
+            os.remove(path)
+            removed += 1
+    return ( kept, removed, )
+
+def tryExportPage(request, Formatter, pageName):
+    """
+    Like `exportPage()` but reports an error instead of raising it.
+
+    @return: Name of the page, report as returned by `failure()` or ``None``
+             on success, manifest entry or ``None`` on failure and profile
+             or ``None``.
+    @rtype: ( unicode, { str: object, ... }, { str: object, ... },
+              { str: object, ... }, )
+    """
+    start = time.time()
+    try:
+        ( entry, profile, ) = exportPage(request, Formatter, pageName)
+    except ( Exception, BudgetExceeded, ), e:
+        return ( pageName, pageFailure(request, pageName, e, start), None,
+                 None, )
+    return ( pageName, None, entry, profile, )
+
+def workerExportPage(pageName):
+    """
+    Export a page in a worker process using the inherited `worker`.
+    """
+    ( request, Formatter, ) = worker
+    return tryExportPage(request, Formatter, pageName)
+
+def renderPageData(request, Formatter, pageName, body):
+    """
+    Render a page to memory for `pipelineExport()`. Errors are reported
+    instead of raised.
+
+    @param body: Text of the page read in advance or ``None``.
+    @return: Name of the page, report as returned by `failure()` or ``None``
+             on success, output or ``None`` on failure, manifest entry or
+             ``None`` on failure and profile or ``None``.
+    @rtype: ( unicode, { str: object, ... }, str, { str: object, ... },
+              { str: object, ... }, )
+    """
+    start = time.time()
+    file = cStringIO.StringIO()
+    try:
+        ( page, outputDigest,
+          profile, ) = renderPage(request, Formatter, pageName, file,
+                                  body=body)
+        entry = manifestEntry(Formatter, page, outputDigest)
+    except ( Exception, BudgetExceeded, ), e:
+        return ( pageName, pageFailure(request, pageName, e, start), None,
+                 None, None, )
+    return ( pageName, None, file.getvalue(), entry, profile, )
+
+def workerRenderPageData(pageName, body=None):
+    """
+    Render a page to memory in a worker process using the inherited
+    `worker`.
+    """
+    ( request, Formatter, ) = worker
+    return renderPageData(request, Formatter, pageName, body)
+
+def readPages(request, pageNames, pages):
+    """
+    Read the text of pages in advance. Run as a thread by
+    `pipelineExport()`.
+
+    @param pages: Receives the name and the text of each page or ``None``
+                  if it could not be read. The end is marked by ``None``.
+    @type pages: Queue.Queue
+    """
+    try:
+        for pageName in pageNames:
+            try:
+                body = openPage(request, pageName).get_raw_body()
+            except Exception:
+                # Reported when rendering
+                body = None
+            pages.put(( pageName, body, ))
+    finally:
+        pages.put(None)
+
+def storePage(pageName, data):
+    """
+    Write the rendered page `data` to its file in the output directory.
+    """
+    path = outputPath(pageName)
+    makeOutputDirectory(path)
+    temporaryPath = path + ".tmp"
+    file = open(temporaryPath, "wb")
+    try:
+        file.write(data)
+    finally:
+        file.close()
+    if options.content_addressed:
+        storeContent(pageName, temporaryPath, hashlib.md5(data).hexdigest())
+    else:
+        os.rename(temporaryPath, path)
+
+def storeResult(store, result):
+    """
+    Store a page rendered to memory.
+
+    @param store: Called with the name of the page and the output.
+    @param result: Page as returned by `renderPageData()`.
+    @return: Result for the page as returned by `tryExportPage()`.
+    @rtype: ( unicode, { str: object, ... }, { str: object, ... },
+              { str: object, ... }, )
+    """
+    ( pageName, error, data, entry, profile, ) = result
+    if error is None:
+        try:
+            store(pageName, data)
+        except EnvironmentError, e:
+            ( error, entry, profile, ) = ( failure(e), None, None, )
+    return ( pageName, error, entry, profile, )
+
+def writePages(rendered, store, slots, results):
+    """
+    Store rendered pages. Run as a thread by `pipelineExport()`.
+
+    @param rendered: Delivers pages as returned by `renderPageData()`. The
+                     end is marked by ``None``.
+    @type rendered: Queue.Queue
+    @param store: Called with the name and the output of every page.
+    @param slots: Released for every page written.
+    @type slots: threading.Semaphore
+    @param results: Receives the result for every page as returned by
+                    `tryExportPage()`.
+    @type results: list
+    """
+    for result in iter(rendered.get, None):
+        results.append(storeResult(store, result))
+        slots.release()
+
+def pipelineExport(request, Formatter, pageNames, pool, store):
+    """
+    Export pages with reading, rendering and writing overlapping. Reading
+    and writing are done by threads linked to the rendering by bounded
+    queues.
+
+    @param pool: Worker processes to render in or ``None`` to render in
+                 this thread.
+    @type pool: multiprocessing.Pool
+    @param store: Called with the name and the output of every page.
+    @return: The results as returned by `tryExportPage()`.
+    @rtype: [ ( unicode, { str: object, ... }, { str: object, ... },
+                { str: object, ... }, ), ... ]
+    """
+    pages = Queue.Queue(options.pipeline)
+    rendered = Queue.Queue()
+    # Limits the pages rendering or waiting to be written
+    slots = threading.Semaphore(options.jobs + options.pipeline)
+    results = [ ]
+    readerRequest = request
+    if not pool:
+        # Requests are not thread safe and `request` renders in this thread
+        readerRequest = createRequest("")
+    reader = threading.Thread(target=readPages,
+                              args=( readerRequest, pageNames, pages, ))
+    writer = threading.Thread(target=writePages,
+                              args=( rendered, store, slots, results, ))
+    for thread in ( reader, writer, ):
+        # Don't keep an interrupted process alive
+        thread.daemon = True
+        thread.start()
+
+    for ( pageName, body, ) in iter(pages.get, None):
+        slots.acquire()
+        if pool:
+            pool.apply_async(workerRenderPageData, ( pageName, body, ),
+                             callback=rendered.put)
+        else:
+            rendered.put(renderPageData(request, Formatter, pageName, body))
+    if pool:
+        # Waits for the callbacks of all pages, too
+        pool.close()
+        pool.join()
+    rendered.put(None)
+    writer.join()
+    return results
+
+def largestFirst(request, pageNames):
+    """
+    @return: `pageNames` sorted by decreasing size of the current revision
+             so big pages don't end up as stragglers.
+    @rtype: [ unicode, ... ]
+    """
+    sizes = dict([ ( pageName, openPage(request, pageName).size(), )
+                   for pageName in pageNames ])
+    return sorted(pageNames, key=sizes.get, reverse=True)
+
+def isUpToDate(request, Formatter, pageName, entry, revisions):
+    """
+    @param entry: Manifest entry of the page from the last run or ``None``.
+    @param revisions: Caches the current revisions of pages. Shared by all
+                      pages checked so a page included by many pages is
+                      looked up only once.
+    @type revisions: { unicode: int, ... }
+    @return: Whether the output of the last run can be kept.
+    @rtype: bool
+    """
+    return (entry is not None
+            and entry["formatter"] == Formatter.version
+            and entry["revision"] == currentRevision(request, pageName,
+                                                     revisions)
+            and ("attachments" in entry) == options.attachments
+            and not dependenciesChanged(request, entry, revisions)
+            and os.path.exists(outputPath(pageName))
+            and (not options.content_addressed
+                 or os.path.exists(contentPath(entry["output"]))))
+
+def currentRevision(request, pageName, revisions):
+    """
+    @return: The current revision of the page named `pageName` or ``0`` if
+             it does not exist.
+    @rtype: int
+    """
+    revision = revisions.get(pageName)
+    if revision is None:
+        page = openPage(request, pageName)
+        # A missing page has a revision of 99999999 in MoinMoin and a
+        # deleted one the revision of its deletion
+        revision = 0
+        if page.exists():
+            revision = page.current_rev()
+        revisions[pageName] = revision
+    return revision
+
+def dependenciesChanged(request, entry, revisions):
+    """
+    @param entry: Manifest entry of a page from the last run.
+    @return: Whether a page included by the page changed or was deleted,
+             an entry of the interwiki map used by it changed or an
+             attachment referenced by it changed since then.
+    @rtype: bool
+    """
+    for ( pageName, revision, ) in entry.get("includes", { }).items():
+        if currentRevision(request, pageName, revisions) != revision:
+            return True
+    interwikiNames = entry.get("interwiki")
+    if interwikiNames:
+        interwikiMap = wikiutil.load_wikimap(request)
+        for ( name, url, ) in interwikiNames.items():
+            if interwikiMap.get(name) != url:
+                return True
+    for ( key, state, ) in entry.get("attachments", { }).items():
+        if attachmentChanged(request, key, state):
+            return True
+    return False
+
+def removeDeletedPages(request, pageNames, manifest):
+    """
+    Remove output and manifest entries of pages which no longer exist.
+
+    @param pageNames: Names of the pages selected. These exist.
+    @return: Number of pages removed.
+    @rtype: int
+    """
+    selected = set(pageNames)
+    deleted = [ pageName
+                for pageName in manifest
+                if pageName not in selected
+                and not openPage(request, pageName).exists() ]
+    for pageName in deleted:
+        try:
+            os.remove(outputPath(pageName))
+        except OSError:
+            pass
+        del manifest[pageName]
+    return len(deleted)
+
+def loadManifest():
+    """
+    @return: Manifest of the last run mapping page names to entries or an
+             empty manifest.
+    @rtype: { unicode: { str: object, ... }, ... }
+    """
+    try:
+        file = open(os.path.join(options.output_directory, manifestName))
+    except IOError:
+        return { }
+    try:
+        return json.load(file)
+    finally:
+        file.close()
+
+def saveManifest(manifest):
+    path = os.path.join(options.output_directory, manifestName)
+    temporaryPath = path + ".tmp"
+    file = open(temporaryPath, "w")
+    try:
+        json.dump(manifest, file, indent=0, sort_keys=True)
+    finally:
+        file.close()
+    os.rename(temporaryPath, path)
+
+def checksumEntries(manifest):
+    """
+    @param manifest: Manifest of this run.
+    @return: Checksums of the pages in `manifest` and of the files exported
+             to the directories of attachments and stored outputs mapped by
+             their path relative to the output directory. Digests are taken
+             from the manifest and the names of the files so nothing is read.
+    @rtype: { str: { str: object, ... }, ... }
+    """
+    files = { }
+    for ( pageName, entry, ) in manifest.items():
+        path = outputPath(pageName)
+        try:
+            status = os.stat(path)
+        except OSError:
+            continue
+        checksum = { "size": status.st_size,
+                     "hash": entry["output"],
+                     "revision": entry["revision"],
+                     "mtime": status.st_mtime, }
+        if os.path.islink(path):
+            checksum["link"] = os.readlink(path)
+        files[outputName(pageName)] = checksum
+    for directory in ( attachmentDirectory, contentDirectory, ):
+        try:
+            names = os.listdir(os.path.join(options.output_directory,
+                                            directory))
+        except OSError:
+            continue
+        for name in names:
+            if name.endswith(".tmp"):
+                # Left over by an interrupted export
+                continue
+            status = os.stat(os.path.join(options.output_directory,
+                                          directory, name))
+            files["%s/%s" % ( directory, name, )] = {
+                "size": status.st_size,
+                "hash": os.path.splitext(name)[0],
+                "mtime": status.st_mtime, }
+    return files
+
+def saveChecksums(manifest):
+    """
+    Write the checksums of all files exported and the delta against the
+    checksums written before.
+
+    @param manifest: Manifest of this run.
+    """
+    path = os.path.join(options.output_directory, checksumsName)
+    previous = { }
+    previousDigest = None
+    try:
+        file = open(path, "rb")
+        try:
+            data = file.read()
+        finally:
+            file.close()
+        previous = json.loads(data)["files"]
+        previousDigest = hashlib.md5(data).hexdigest()
+    except ( IOError, ValueError, KeyError, ):
+        pass
+
+    files = checksumEntries(manifest)
+    data = json.dumps({ "hash": "md5", "files": files, }, indent=0,
+                      sort_keys=True)
+    writeOutputFile(path, data)
+
+    # Modification times alone don't make a file worth fetching
+    keys = ( "hash", "size", "link", )
+    delta = { "previous": previousDigest,
+              "current": hashlib.md5(data).hexdigest(),
+              "added": sorted(set(files) - set(previous)),
+              "changed": sorted([ name
+                                  for name in files
+                                  if name in previous
+                                  and ([ files[name].get(key) for key in keys ]
+                                       != [ previous[name].get(key)
+                                            for key in keys ]) ]),
+              "removed": sorted(set(previous) - set(files)), }
+    writeOutputFile(os.path.join(options.output_directory, deltaName),
+                    json.dumps(delta, indent=0, sort_keys=True))
+    sys.stderr.write("%d files listed, %d added, %d changed, %d removed\n"
+                     % ( len(files), len(delta["added"]),
+                         len(delta["changed"]), len(delta["removed"]), ))
+
+def writeOutputFile(path, data):
+    """
+    Replace the file `path` by one containing `data` so readers never see
+    a partial file.
+    """
+    temporaryPath = path + ".tmp"
+    file = open(temporaryPath, "wb")
+    try:
+        file.write(data)
+    finally:
+        file.close()
+    os.rename(temporaryPath, path)
+
+class TarArchive(object):
+    """
+    A tar archive written as a stream so it may go to a pipe or tape.
+    """
+
+    _mode = "w|"
+
+    def __init__(self, path):
+        self._tar = tarfile.open(path, self._mode)
+        self._mtime = time.time()
+
+    def add(self, pageName, data):
+        """
+        Add the output `data` of the page `pageName`.
+        """
+        info = tarfile.TarInfo(outputName(pageName))
+        info.size = len(data)
+        info.mtime = self._mtime
+        info.mode = 0644
+        self._tar.addfile(info, cStringIO.StringIO(data))
+
+    def addFile(self, name, path):
+        """
+        Add the file `path` as `name` without reading it to memory.
+        """
+        file = open(path, "rb")
+        try:
+            info = tarfile.TarInfo(name)
+            info.size = os.fstat(file.fileno()).st_size
+            info.mtime = self._mtime
+            info.mode = 0644
+            self._tar.addfile(info, file)
+        finally:
+            file.close()
+
+    def close(self):
+        self._tar.close()
+
+class GzipTarArchive(TarArchive):
+
+    _mode = "w|gz"
+
+class Bzip2TarArchive(TarArchive):
+
+    _mode = "w|bz2"
+
+class ZipArchive(object):
+    """
+    A zip archive with compressed members.
+    """
+
+    def __init__(self, path):
+        self._zip = zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED,
+                                    allowZip64=True)
+        self._dateTime = time.localtime()[:6]
+
+    def add(self, pageName, data):
+        # A unicode name is flagged as UTF-8 in the archive
+        info = zipfile.ZipInfo(outputName(pageName).decode(config.charset),
+                               self._dateTime)
+        info.compress_type = zipfile.ZIP_DEFLATED
+        info.external_attr = 0644 << 16
+        self._zip.writestr(info, data)
+
+    def addFile(self, name, path):
+        self._zip.write(path, name, zipfile.ZIP_DEFLATED)
+
+    def close(self):
+        self._zip.close()
+
+class PackArchive(object):
+    """
+    Pages concatenated in a pack file which is only ever appended to. The
+    index next to it maps page names to offset and length of the pages so
+    single pages can be read directly. Attachments are indexed by their
+    name in the archive. The index is replaced only when the
+    pack is closed so an interrupted export leaves the previous index
+    valid.
+    """
+
+    def __init__(self, path):
+        self._indexPath = path + ".index"
+        """
+        Offset and length of each page.
+        @type: { unicode: [ int, int, ], ... }
+        """
+        self._index = { }
+        try:
+            file = open(self._indexPath)
+        except IOError:
+            pass
+        else:
+            try:
+                self._index = json.load(file)
+            finally:
+                file.close()
+        self._file = open(path, "ab")
+        self._file.seek(0, os.SEEK_END)
+        self._offset = self._file.tell()
+
+    def add(self, pageName, data):
+        self._file.write(data)
+        self._index[pageName] = [ self._offset, len(data), ]
+        self._offset += len(data)
+
+    def addFile(self, name, path):
+        if name in self._index:
+            # Named by the digest so the same content is in the pack already
+            return
+        file = open(path, "rb")
+        try:
+            shutil.copyfileobj(file, self._file, 1 << 20)
+        finally:
+            file.close()
+        length = self._file.tell() - self._offset
+        self._index[name.decode(config.charset)] = [ self._offset, length, ]
+        self._offset += length
+
+    def close(self):
+        self._file.close()
+        temporaryPath = self._indexPath + ".tmp"
+        file = open(temporaryPath, "w")
+        try:
+            json.dump(self._index, file, indent=0, sort_keys=True)
+        finally:
+            file.close()
+        os.rename(temporaryPath, self._indexPath)
+
+"""
+@var archiveExtensions: Archive classes by the extension of the archive.
+@type archiveExtensions: [ ( str, type, ), ... ]
+"""
+archiveExtensions = [ ( ".tar", TarArchive, ),
+                      ( ".tar.gz", GzipTarArchive, ),
+                      ( ".tgz", GzipTarArchive, ),
+                      ( ".tar.bz2", Bzip2TarArchive, ),
+                      ( ".zip", ZipArchive, ),
+                      ( ".pack", PackArchive, ), ]
+
+def archiveClass(path):
+    """
+    @return: Class of the archive `path` according to its extension or
+             ``None`` if the extension is unknown.
+    @rtype: type
+    """
+    for ( extension, Archive, ) in archiveExtensions:
+        if path.lower().endswith(extension):
+            return Archive
+    return None
+
+def archiveAttachments(request, archive, entry, archived):
+    """
+    Add the attachments a page refers to to the archive unless their
+    content was added already.
+
+    @param entry: Manifest entry of the page.
+    @param archived: Names of the copies added to the archive. Updated.
+    @type archived: set
+    """
+    for ( key, state, ) in entry.get("attachments", { }).items():
+        if state is None or state[2] in archived:
+            continue
+        ( attachedTo, fileName, ) = key.rsplit(u"/", 1)
+        try:
+            archive.addFile("%s/%s" % ( attachmentDirectory,
+                                        state[2].encode(config.charset), ),
+                            attachmentPath(request, attachedTo, fileName))
+        except EnvironmentError, e:
+            # Removed since the page was rendered
+            sys.stderr.write("Attachment %s not archived: %s\n"
+                             % ( key.encode(config.charset), e, ))
+            continue
+        archived.add(state[2])
+
+def exportPages(request, Formatter, pageNames, manifest, profiles):
+    """
+    Render all pages in `pageNames` to the output directory. Errors are
+    reported but do not stop the export.
+
+    @param manifest: Manifest of the last run. Updated for the pages
+                     converted.
+    @param profiles: Receives the profiles of the pages converted when
+                     profiling.
+    @type profiles: { unicode: { str: object, ... }, ... }
+    @return: Reports on the pages which failed as returned by `failure()`.
+    @rtype: { unicode: { str: object, ... }, ... }
+    """
+    global worker, budgetFactor
+    unchanged = removed = 0
+    if options.incremental:
+        if Formatter.version is None:
+            # Any output would be taken for the output of this formatter
+            raise RuntimeError("-i/--incremental needs the version of the"
+                               " formatter but its module can't be read")
+        removed = removeDeletedPages(request, pageNames, manifest)
+        revisions = { }
+        outdated = [ pageName
+                     for pageName in pageNames
+                     if not isUpToDate(request, Formatter, pageName,
+                                       manifest.get(pageName), revisions) ]
+        unchanged = len(pageNames) - len(outdated)
+        pageNames = outdated
+
+    pool = None
+    if options.jobs > 1:
+        worker = ( request, Formatter, )
+        pool = multiprocessing.Pool(options.jobs)
+    archive = None
+    store = storePage
+    if options.archive:
+        archive = archiveClass(options.archive)(options.archive)
+        store = archive.add
+    if pool:
+        pageNames = largestFirst(request, pageNames)
+
+    failures = { }
+    archived = set()
+    try:
+        if options.pipeline:
+            results = pipelineExport(request, Formatter, pageNames, pool,
+                                     store)
+        elif archive:
+            # Pages are rendered to memory and added by this process only
+            if pool:
+                rendered = pool.imap_unordered(workerRenderPageData,
+                                               pageNames, 1)
+            else:
+                rendered = ( renderPageData(request, Formatter, pageName,
+                                            None)
+                             for pageName in pageNames )
+            results = ( storeResult(store, result) for result in rendered )
+        elif pool:
+            results = pool.imap_unordered(workerExportPage, pageNames, 1)
+        else:
+            results = ( tryExportPage(request, Formatter, pageName)
+                        for pageName in pageNames )
+
+        retrying = False
+        while True:
+            retries = [ ]
+            for ( pageName, error, entry, profile, ) in results:
+                if error is None:
+                    manifest[pageName] = entry
+                    if archive and options.attachments:
+                        archiveAttachments(request, archive, entry, archived)
+                    if profile is not None:
+                        profiles[pageName] = profile
+                elif error["exceeded"] and not retrying:
+                    retries.append(pageName)
+                    writeFailure(pageName, error, "trying again later")
+                else:
+                    failures[pageName] = error
+                    writeFailure(pageName, error)
+            if not retries:
+                break
+            # One after the other in this process so the pages don't compete
+            # with others for time and memory and with a larger budget so
+            # pages just above it are not aborted again
+            retrying = True
+            budgetFactor = retryBudgetFactor
+            results = ( storeResult(store, renderPageData(request, Formatter,
+                                                          pageName, None))
+                        for pageName in retries )
+    finally:
+        budgetFactor = 1
+        if pool:
+            pool.terminate()
+        if archive:
+            archive.close()
+    sys.stderr.write("%d pages converted, %d unchanged, %d removed, %d failed\n"
+                     % ( len(pageNames) - len(failures), unchanged, removed,
+                         len(failures), ))
+    if options.content_addressed:
+        ( stored, removed, ) = removeUnreferencedContent(manifest)
+        sys.stderr.write("%d distinct outputs stored, %d no longer referenced removed\n"
+                         % ( stored, removed, ))
+    if options.output_directory:
+        # Also after exporting without -t/--attachments no page refers to
+        # the copies any more
+        ( kept, removed, ) = removeUnreferencedAttachments(manifest)
+        if options.attachments:
+            sys.stderr.write("%d attachments stored, %d no longer referenced removed\n"
+                             % ( kept, removed, ))
+    if options.failures:
+        saveFailures(failures)
+    return failures
+
+def writeFailure(pageName, error, consequence=None):
+    """
+    Report a page which failed on stderr.
+
+    @param error: Report as returned by `failure()`.
+    @param consequence: What happens to the page next if anything.
+    @type consequence: str
+    """
+    message = error["error"]
+    if error["exceeded"]:
+        message += " after %.1f seconds converting %d bytes" % (
+            error["seconds"], error["size"] or 0, )
+    if consequence:
+        message += "; %s" % ( consequence, )
+    message = u"%s: %s\n" % ( pageName, message, )
+    sys.stderr.write(message.encode(config.charset))
+
+def saveFailures(failures):
+    """
+    Write the reports on the pages which failed to the file given by
+    -F/--failures.
+    """
+    file = open(options.failures, "w")
+    try:
+        json.dump(failures, file, indent=0, sort_keys=True)
+    finally:
+        file.close()
+
+###############################################################################
+
+# Links to other pages are left for the consumer of the output to resolve
+_reIgnoredProblem = re.compile(r"^Unknown target name: ")
+
+def validatePage(path):
+    """
+    Parse the reStructuredText in the file `path` with docutils.
+
+    @return: Problems found sorted by line. Each gives the line if known,
+             the level like "WARNING" or "ERROR" and the message.
+    @rtype: [ { str: object, ... }, ... ]
+    """
+    file = open(path, "rb")
+    try:
+        text = file.read().decode(config.charset)
+    finally:
+        file.close()
+    document = docutils.core.publish_doctree(
+        text, source_path=path,
+        settings_overrides={ "report_level": 2,
+                             "halt_level": 5,
+                             "warning_stream": False, })
+    problems = [ ]
+    for message in document.traverse(docutils.nodes.system_message):
+        text = u""
+        if message.children:
+            text = message.children[0].astext()
+        # Informational messages are no problems
+        if (message["level"] >= 2
+            and not _reIgnoredProblem.search(text)):
+            problems.append({ "line": message.get("line"),
+                              "level": message["type"],
+                              "message": text, })
+    problems.sort(key=lambda problem: problem["line"])
+    return problems
+
+def workerValidatePage(pageName):
+    """
+    Like `validatePage()` for the output of `pageName` but reports an error
+    of docutils as a problem instead of raising it.
+
+    @return: Name of the page and problems found.
+    @rtype: ( unicode, [ { str: object, ... }, ... ], )
+    """
+    try:
+        problems = validatePage(outputPath(pageName))
+    except Exception, e:
+        problems = [ { "line": None,
+                       "level": "FAILURE",
+                       "message": "%s: %s" % ( e.__class__.__name__, e, ), }, ]
+    return ( pageName, problems, )
+
+def validatePages(pageNames, manifest):
+    """
+    Parse the output of the pages converted with docutils and write the
+    problems found to the file given by -V/--validate.
+
+    @param pageNames: Names of the pages selected. Pages without manifest
+                      entry failed and are skipped.
+    @param manifest: Manifest of this run.
+    @return: Number of pages with problems.
+    @rtype: int
+    """
+    digests = dict([ ( pageName, manifest[pageName]["output"], )
+                     for pageName in pageNames
+                     if pageName in manifest ])
+    cache = loadValidationCache()
+    # Pages with the same output need to be parsed only once
+    pending = { }
+    for ( pageName, digest, ) in sorted(digests.items()):
+        if digest not in cache:
+            pending.setdefault(digest, pageName)
+
+    pool = None
+    if options.jobs > 1 and len(pending) > 1:
+        pool = multiprocessing.Pool(options.jobs)
+    try:
+        if pool:
+            results = pool.imap_unordered(workerValidatePage,
+                                          pending.values(), 1)
+        else:
+            results = ( workerValidatePage(pageName)
+                        for pageName in pending.values() )
+        for ( pageName, problems, ) in results:
+            cache[digests[pageName]] = problems
+    finally:
+        if pool:
+            pool.terminate()
+
+    # Keep only results for output still around
+    current = set([ entry["output"] for entry in manifest.values() ])
+    saveValidationCache(dict([ ( digest, problems, )
+                               for ( digest, problems, ) in cache.items()
+                               if digest in current ]))
+    report = dict([ ( pageName, cache[digest], )
+                    for ( pageName, digest, ) in digests.items()
+                    if cache[digest] ])
+    file = open(options.validate, "w")
+    try:
+        json.dump(report, file, indent=1, sort_keys=True)
+    finally:
+        file.close()
+    sys.stderr.write("%d pages validated, %d outputs parsed, %d with problems\n"
+                     % ( len(digests), len(pending), len(report), ))
+    return len(report)
+
+def loadValidationCache():
+    """
+    @return: Problems found by the last runs mapped by the digest of the
+             output. Empty if docutils changed meanwhile.
+    @rtype: { str: [ { str: object, ... }, ... ], ... }
+    """
+    try:
+        file = open(os.path.join(options.output_directory, validationName))
+    except IOError:
+        return { }
+    try:
+        try:
+            cache = json.load(file)
+        except ValueError:
+            return { }
+    finally:
+        file.close()
+    if cache.get("docutils") != docutils.__version__:
+        return { }
+    return cache["results"]
+
+def saveValidationCache(results):
+    path = os.path.join(options.output_directory, validationName)
+    temporaryPath = path + ".tmp"
+    file = open(temporaryPath, "w")
+    try:
+        json.dump({ "docutils": docutils.__version__, "results": results, },
+                  file, indent=0, sort_keys=True)
+    finally:
+        file.close()
+    os.rename(temporaryPath, path)
+
+###############################################################################
+
+class MethodProfile(object):
+    """
+    Records calls of formatter methods and the output they produce while
+    rendering a page. Used by formatter classes created by
+    `profiledFormatter()`.
+    """
+
+    """
+    Name output is accounted to when no formatter method is active. This
+    is output returned by formatter methods and written by the parser.
+    """
+    outsideName = "(outside)"
+
+    def __init__(self):
+        """
+        Maps method names to ``[ calls, cumulative, self, bytes, ]``.
+        @type: { str: list, ... }
+        """
+        self._name2Stats = { }
+        """
+        Active methods as ``[ name, time spent in called methods, ]``.
+        @type: [ list, ... ]
+        """
+        self._stack = [ ]
+        """
+        Maps method names to the number of their active calls.
+        @type: { str: int, ... }
+        """
+        self._name2Active = { }
+        self._start = time.time()
+
+    def _stats(self, name):
+        stats = self._name2Stats.get(name)
+        if stats is None:
+            stats = self._name2Stats[name] = [ 0, 0.0, 0.0, 0, ]
+        return stats
+
+    def call(self, name, method, formatter, args, kw):
+        """
+        Call `method` of `formatter` and record the call under `name`.
+        """
+        frame = [ name, 0.0, ]
+        self._stack.append(frame)
+        active = self._name2Active.get(name, 0)
+        self._name2Active[name] = active + 1
+        start = time.time()
+        try:
+            return method(formatter, *args, **kw)
+        finally:
+            elapsed = time.time() - start
+            self._stack.pop()
+            self._name2Active[name] = active
+            stats = self._stats(name)
+            stats[0] += 1
+            if not active:
+                # Recursive calls are contained in the outermost one
+                stats[1] += elapsed
+            stats[2] += elapsed - frame[1]
+            if self._stack:
+                self._stack[-1][1] += elapsed
+
+    def output(self, size):
+        """
+        Account `size` bytes of output to the outermost active method. This
+        is the method called by the parser.
+        """
+        if self._stack:
+            name = self._stack[0][0]
+        else:
+            name = self.outsideName
+        self._stats(name)[3] += size
+
+    def report(self):
+        """
+        @return: Total time and statistics per method.
+        @rtype: { str: object, ... }
+        """
+        return { "seconds": time.time() - self._start,
+                 "methods": dict([ ( name, { "calls": stats[0],
+                                             "cumulative": stats[1],
+                                             "self": stats[2],
+                                             "bytes": stats[3], }, )
+                                   for ( name, stats, ) in self._name2Stats.items() ]), }
+
+def profiledFormatter(Formatter):
+    """
+    @return: A subclass of `Formatter` recording every call of its methods
+             in the `MethodProfile` set as `_methodProfile`.
+    @rtype: type
+    """
+    def profiled(name, method):
+        def call(self, *args, **kw):
+            return self._methodProfile.call(name, method, self, args, kw)
+        call.__name__ = name
+        return call
+
+    # The formatter may be a classic class so `type()` can't be used
+    class ProfiledFormatter(Formatter):
+        pass
+
+    for ( name, method, ) in inspect.getmembers(Formatter, inspect.ismethod):
+        # Setting up the state is no formatting and happens before a profile
+        # is set
+        if (not name.startswith("__")
+            and name not in ( "reset", "_initialize", )):
+            setattr(ProfiledFormatter, name, profiled(name, method.im_func))
+    return ProfiledFormatter
+
+def saveProfile(profiles):
+    """
+    Write the profiles of all pages and their sum to the file given by
+    -P/--profile.
+
+    @param profiles: Maps page names to profiles.
+    @type profiles: { unicode: { str: object, ... }, ... }
+    """
+    total = { }
+    seconds = 0.0
+    for profile in profiles.values():
+        seconds += profile["seconds"]
+        for ( name, stats, ) in profile["methods"].items():
+            totalStats = total.setdefault(name, dict.fromkeys(stats, 0))
+            for ( key, value, ) in stats.items():
+                totalStats[key] += value
+    temporaryPath = options.profile + ".tmp"
+    file = open(temporaryPath, "w")
+    try:
+        json.dump({ "pages": profiles,
+                    "total": { "seconds": seconds, "methods": total, }, },
+                  file, indent=1, sort_keys=True)
+    finally:
+        file.close()
+    os.rename(temporaryPath, options.profile)
+
+def saveTimings(profiles):
+    """
+    Write the seconds spent converting every page to the file given by
+    --timings.
+
+    @param profiles: Maps page names to profiles.
+    @type profiles: { unicode: { str: object, ... }, ... }
+    """
+    file = open(options.timings, "w")
+    try:
+        json.dump(dict([ ( pageName, profile["seconds"], )
+                         for ( pageName, profile, ) in profiles.items() ]),
+                  file, indent=0, sort_keys=True)
+    finally:
+        file.close()
+
+###############################################################################
+
+# Protocol between server and client
+#
+# The client sends its working directory and its arguments as a JSON list of
+# strings followed by a linefeed. Strings are decoded as ISO-8859-1 so
+# arbitrary bytes survive. The server answers with frames consisting of a
+# channel, the length of the data and a linefeed followed by the data.
+# Channel "1" is data for stdout, "2" for stderr and "x" gives the exit
+# status and ends the answer.
+
+class FrameWriter(object):
+    """
+    File like object writing frames of a channel to a client.
+    """
+
+    def __init__(self, file, channel):
+        self._file = file
+        self._channel = channel
+
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode(config.charset, "replace")
+        if data:
+            self._file.write("%s%d\n%s" % ( self._channel, len(data), data, ))
+
+    def flush(self):
+        self._file.flush()
+
+class ConversionHandler(SocketServer.StreamRequestHandler):
+    """
+    Converts pages for one client. Runs in a process forked from the server
+    so it may change global state freely.
+    """
+
+    def handle(self):
+        global options
+        serverOptions = options
+        ( cwd, args, ) = self._readRequest()
+        sys.stdout = FrameWriter(self.wfile, "1")
+        sys.stderr = FrameWriter(self.wfile, "2")
+        sys.stdin = open(os.devnull)
+        try:
+            try:
+                # Relative paths given by the client are relative to its
+                # working directory
+                os.chdir(cwd)
+                sys.argv = [ sys.argv[0], ] + args
+                args = parseOptions()
+                if options.serve:
+                    raise RuntimeError("-S/--serve not allowed for a client")
+                if options.list == "-":
+                    raise RuntimeError("-l/--list cannot read from stdin of a client")
+                options.directory = serverOptions.directory
+                options.data_directory = serverOptions.data_directory
+                os.chdir(options.directory)
+                status = convert(args)
+            except SystemExit, e:
+                status = e.code
+                if status is None:
+                    status = 0
+                elif not isinstance(status, int):
+                    sys.stderr.write("%s\n" % ( status, ))
+                    status = 1
+            except:
+                traceback.print_exc()
+                status = 1
+        finally:
+            sys.stdout.flush()
+        self.wfile.write("x%d\n" % ( len(str(status)), ))
+        self.wfile.write(str(status))
+
+    def _readRequest(self):
+        """
+        @return: Working directory and arguments of the client.
+        @rtype: ( str, [ str, ... ], )
+        """
+        request = [ string.encode("iso-8859-1")
+                    for string in json.loads(self.rfile.readline()) ]
+        return ( request[0], request[1:], )
+
+class ConversionServer(SocketServer.ForkingMixIn,
+                       SocketServer.UnixStreamServer):
+    pass
+
+def serve():
+    """
+    Serve clients on the socket given by -S/--serve until interrupted.
+    """
+    # Load configuration and formatter once so every forked handler inherits
+    # them
+    request = createRequest("")
+    loadFormatter(request)
+
+    try:
+        if stat.S_ISSOCK(os.stat(options.serve).st_mode):
+            # Left over from a previous server
+            os.remove(options.serve)
+    except OSError:
+        pass
+    server = ConversionServer(options.serve, ConversionHandler)
+    # Terminate cleanly on the usual signal of service managers
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    pid = os.getpid()
+    try:
+        server.serve_forever()
+    finally:
+        # Handlers are forked from here and must not remove the socket
+        if os.getpid() == pid:
+            os.remove(options.serve)
+
+###############################################################################
+
+def convert(args):
+    """
+    Convert according to the options.
+
+    @param args: Arguments as returned by `parseOptions()`.
+    @return: Exit status.
+    @rtype: int
+    """
+    statsProfile = None
+    if options.profile_stats:
+        statsProfile = cProfile.Profile()
+        statsProfile.enable()
+    profiles = { }
+    try:
+        if options.bulk:
+            request = createRequest("")
+            Formatter = loadFormatter(request)
+            if options.profile:
+                Formatter = profiledFormatter(Formatter)
+            # Archives have no manifest
+            manifest = { }
+            if options.output_directory:
+                manifest = loadManifest()
+            pageNames = selectPages(request)
+            try:
+                failures = exportPages(request, Formatter, pageNames,
+                                       manifest, profiles)
+                if options.validate:
+                    validatePages(pageNames, manifest)
+            finally:
+                if options.output_directory:
+                    saveManifest(manifest)
+            if options.checksums:
+                saveChecksums(manifest)
+            if failures:
+                return 1
+        else:
+            ( pageName, ) = args
+            request = createRequest(pageName)
+            Formatter = loadFormatter(request)
+            if options.profile:
+                Formatter = profiledFormatter(Formatter)
+            ( page, outputDigest,
+              profile, ) = renderPage(request, Formatter, pageName,
+                                      sys.stdout, revision=options.revision)
+            if profile is not None:
+                if isinstance(pageName, str):
+                    pageName = pageName.decode(config.charset, "replace")
+                profiles[pageName] = profile
+        return 0
+    finally:
+        if statsProfile is not None:
+            statsProfile.disable()
+            statsProfile.dump_stats(options.profile_stats)
+        if options.profile:
+            saveProfile(profiles)
+        if options.timings:
+            saveTimings(profiles)
+
 ###############################################################################
 ###############################################################################
 # Now work
 
 if __name__ == '__main__':
-    ( pageName, ) = parseOptions()
+    args = parseOptions()
 
     # Needed so relative paths in configuration are found
     os.chdir(options.directory)
+    options.directory = os.getcwd()
     # Needed to load configuration
     sys.path = [ os.getcwd(), ] + sys.path
-    url = re.sub("%", re.escape(pageName), options.url_template)
-
-    request = RequestCLI(url=url, pagename=pageName)
-
-    Formatter = wikiutil.importPlugin(request.cfg, "formatter",
-                                      "text_x-rst", "Formatter")
-    formatter = Formatter(request)
-    request.formatter = formatter
-
-    page = Page(request, pageName, rev=options.revision, formatter=formatter)
-    if not page.exists():
-        raise RuntimeError("No page named %r" % ( pageName, ))
 
-    page.send_page()
+    if options.serve:
+        try:
+            serve()
+        except KeyboardInterrupt:
+            pass
+    else:
+        sys.exit(convert(args))
 
 # TODO Extension for reStructuredText parser in MoinMoin:
 #
@@ -0,0 +1,90 @@
+#! /usr/bin/env python
+# -*- coding: iso-8859-1 -*-
+
+"""
+Client for a server started by ``moin2rst.py -S <socket>``.
+
+Takes the same options and arguments as ``moin2rst.py`` and has the server
+do the conversion. The socket of the server is taken from the environment
+variable MOIN2RST_SOCKET. Only the standard library is used so the client
+starts fast.
+"""
+
+###############################################################################
+###############################################################################
+# Import
+
+import sys
+import os
+import socket
+import json
+
+###############################################################################
+###############################################################################
+# Variables
+
+"""
+@var socketVariable: Environment variable naming the socket of the server.
+@type socketVariable: str
+"""
+socketVariable = "MOIN2RST_SOCKET"
+
+###############################################################################
+###############################################################################
+# Functions
+
+def connect(path):
+    """
+    @return: A socket connected to the server listening on `path`.
+    @rtype: socket.socket
+    """
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    connection.connect(path)
+    return connection
+
+def convert(connection, args):
+    """
+    Have the server convert according to `args` and pass its output on.
+
+    See "Protocol between server and client" in ``moin2rst.py``.
+
+    @return: Exit status of the conversion.
+    @rtype: int
+    """
+    request = [ string.decode("iso-8859-1")
+                for string in [ os.getcwd(), ] + args ]
+    connection.sendall(json.dumps(request) + "\n")
+
+    answer = connection.makefile("rb")
+    channels = { "1": sys.stdout, "2": sys.stderr, }
+    while True:
+        header = answer.readline()
+        if not header:
+            sys.stderr.write("%s: Server closed the connection\n"
+                             % ( sys.argv[0], ))
+            return 1
+        ( channel, length, ) = ( header[0], int(header[1:]), )
+        data = answer.read(length)
+        if channel == "x":
+            return int(data)
+        channels[channel].write(data)
+
+###############################################################################
+###############################################################################
+# Now work
+
+if __name__ == '__main__':
+    path = os.environ.get(socketVariable)
+    if not path:
+        sys.stderr.write("%s: %s must name the socket of the server\n"
+                         % ( sys.argv[0], socketVariable, ))
+        sys.exit(2)
+    try:
+        connection = connect(path)
+    except socket.error, e:
+        sys.stderr.write("%s: %s: %s\n" % ( sys.argv[0], path, e, ))
+        sys.exit(2)
+    try:
+        sys.exit(convert(connection, sys.argv[1:]))
+    finally:
+        connection.close()
@@ -6,23 +6,54 @@
 """
 
 import re
+import hashlib
+import array
 
 from MoinMoin.parser.text_moin_wiki import Parser
 from MoinMoin.formatter import FormatterBase
+from MoinMoin.action import AttachFile
+from MoinMoin.macro import Include
 from MoinMoin import wikiutil
+from MoinMoin import config
 
 # TODO Test with others than the standard MoinMoin "wiki" parser; in particular
 #      test with reStructuredText pages
 
+###############################################################################
+###############################################################################
+# Functions
+
+def _sourceVersion():
+    """
+    @return: Digest of the source of this module or if that can't be read
+             of the compiled module. Changes whenever the formatter changes
+             so stored renderings can be recognized as outdated. ``None``
+             if neither can be read so no version is known.
+    @rtype: str
+    """
+    for path in ( re.sub(r"\.py[co]$", ".py", __file__), __file__, ):
+        try:
+            file = open(path, "rb")
+        except IOError:
+            continue
+        try:
+            return hashlib.md5(file.read()).hexdigest()
+        finally:
+            file.close()
+    return None
+
 ###############################################################################
 ###############################################################################
 # Classes
 
 class Style(object):
     """
-    Description of a style as used in reStructuredText.
+    Description of a style as used in reStructuredText. Instances are
+    immutable and may be shared.
     """
 
+    __slots__ = ( "_name", "_startString", "_endString", )
+
     def __init__(self, name, startString=None, endString=None):
         """
         @param name: Name of this style.
@@ -30,16 +61,16 @@ class Style(object):
                             by `name` is used.
         @param endString: End string to use. If ``None`` a text role is used.
         """
+        if startString is None:
+            startString = u":%s:`" % ( name, )
+        if endString is None:
+            endString = u"`"
         self._name = name
         self._startString = startString
         self._endString = endString
 
     def getMarkup(self, content):
-        if self._startString is None:
-            self._startString = u":%s:`" % ( self._name, )
-        if self._endString is None:
-            self._endString = u"`"
-        return u"%s%s%s" % ( self._startString, content, self._endString, )
+        return self._startString + content + self._endString
 
 ###############################################################################
 
@@ -48,6 +79,8 @@ class LinkStyle(Style):
     Style to describe a link.
     """
 
+    __slots__ = ( "_url", "_formatter", )
+
     def __init__(self, name, url, formatter):
         Style.__init__(self, name)
         self._url = url
@@ -72,12 +105,10 @@ class LinkStyle(Style):
                 return u"%s" % ( description, )
         else:
             # If description is not the URL then it needs mapping
-            found = [ pair
-                      for pair in self._formatter._description_urls
-                      if pair[0] == description ]
-            if not found:
-                self._formatter._description_urls.append(( description, url, ))
-            elif found[0][1] == url:
+            found = self._formatter._description2Url.get(description)
+            if found is None:
+                self._formatter._addLinkTarget(description, url)
+            elif found == url:
                 # Duplicate
                 pass
             else:
@@ -97,15 +128,71 @@ class Formatter(FormatterBase):
     Format stuff as reStructuredText.
     """
 
-    def __init__(self, request, **kw):
+    """
+    Version of the formatter used to recognize outdated renderings or
+    ``None`` if unknown.
+    @type: str
+    """
+    version = _sourceVersion()
+
+    def __init__(self, request, sink=None, attachmentUrl=None, **kw):
+        """
+        @param sink: If given output is written to this as soon as it is
+                     final and the methods return empty strings. Otherwise
+                     output is returned by the methods.
+        @type sink: Object with a method `write(str)`
+        @param attachmentUrl: If given called with the name of the page and
+                              the file name of every attachment referenced.
+                              Returns the URL to link to instead of the
+                              attachment or ``None`` to keep the reference.
+        @type attachmentUrl: callable
+        """
         # Initialize globally accessible flags
         FormatterBase.__init__(self, request, **kw)
+        self._initialize(sink, attachmentUrl)
+
+    def reset(self, page=None, sink=None, attachmentUrl=None):
+        """
+        Discard all state left over from the page rendered last. A formatter
+        reset renders exactly like a new one so one instance can be reused
+        for many pages.
+
+        @param page: Page to render next or ``None`` to set it later by
+                     `setPage()`.
+        @param sink: Like for the constructor.
+        @param attachmentUrl: Like for the constructor.
+        """
+        FormatterBase.__init__(self, self.request,
+                               store_pagelinks=self._store_pagelinks,
+                               terse=self._terse)
+        self._initialize(sink, attachmentUrl)
+        self.setPage(page)
+
+    def _initialize(self, sink, attachmentUrl):
+        """
+        Set up the state for rendering a page from scratch.
+        """
+        """
+        Object final output is written to or ``None``.
+        @type: Object with a method `write(str)`
+        """
+        self._sink = sink
+        """
+        Maps attachments to the URLs to link to or ``None``.
+        @type: callable
+        """
+        self._attachmentUrl = attachmentUrl
         """
         Current indentation in characters.
         @type: int
         """
         self._indentation = 0
         """
+        Indentation string for `_indentation`; recomputed when that changes.
+        @type: str
+        """
+        self._indentString = u""
+        """
         Was last line completed by a linefeed?
         @type: bool
         """
@@ -116,8 +203,9 @@ class Formatter(FormatterBase):
         """
         self._substitution2Image = { }
         """
-        Current list of strings collecting text which is meant to be output.
-        @type: [ str, ... ]
+        Current stack of collectors. Each collector is a list of strings
+        collecting text which is meant to be output.
+        @type: [ [ str, ... ], ... ]
         """
         self._collectors = [ ]
         """
@@ -126,40 +214,76 @@ class Formatter(FormatterBase):
         """
         self._openLists = [ ]
         """
-        Text output since last linefeed.
-        @type: str
+        Current list of open tables.
+        @type: [ Formatter.Table, ... ]
         """
-        self._sinceEOL = u""
+        self._openTables = [ ]
         """
-        Text output since last block start.
-        @type: str
+        Collector of the current table cell or ``None`` if not in a cell.
+        Output to it is indented relative to the cell.
+        @type: [ str, ... ]
+        """
+        self._cellCollector = None
+        """
+        Was non-empty text output since last linefeed?
+        @type: bool
+        """
+        self._sinceEOL = False
+        """
+        Was non-empty text output since last block start?
+        @type: bool
         """
-        self._sinceBLK = u""
+        self._sinceBLK = False
         """
-        Current inline style.
-        @type: Style
+        Stack of open inline styles. Only the last one has its content
+        collected; the others are suspended.
+        @type: [ Style, ... ]
         """
-        self._currentStyle = None
+        self._styles = [ ]
         """
         A space pends to be output.
         @type: bool
         """
         self._spacePending = u""
         """
-        Maps descriptions to URLs
-        @type: [ ( str, str, ), ... ]
+        Maps descriptions to URLs.
+        @type: { str: str, ... }
+        """
+        self._description2Url = { }
+        """
+        Maps URLs to their descriptions in the order they were added.
+        @type: { str: [ str, ... ], ... }
+        """
+        self._url2Descriptions = { }
+        """
+        URLs in `_url2Descriptions` in the order they were added first.
+        @type: [ str, ... ]
         """
-        self._description_urls = [ ]
+        self._urls = [ ]
         """
         Number of last footnote.
         @type: int
         """
         self._lastFootNote = 0
         """
-        Maps numbers to footnote texts not output so far.
-        @type: { int: str, ... ]
+        Labels and texts of the footnotes not output so far in the order they
+        were referenced.
+        @type: [ ( unicode, unicode, ), ... ]
         """
-        self._number2Footnote = { }
+        self._footnotes = [ ]
+        """
+        Footnotes of an included page are labeled by this prefix and their
+        number so they don't clash with the footnotes of the pages including
+        it. ``None`` for the page rendered at the top which numbers its
+        footnotes.
+        @type: unicode
+        """
+        self._footnotePrefix = None
+        """
+        Prefixes of the footnote labels in the output so far.
+        @type: set
+        """
+        self._footnotePrefixes = set()
         """
         Name of the rendered page.
         @type: str
@@ -170,6 +294,55 @@ class Formatter(FormatterBase):
         @type: int
         """
         self._contentsDepth = None
+        """
+        Maps the names of the pages included by `[[Include()]]` directly or
+        indirectly to their revisions. Pages the user may not read are
+        contained, too, because the output changes when their access rights
+        change. Pages which don't exist are contained with revision ``0``
+        because the output changes when they are created.
+        @type: { unicode: int, ... }
+        """
+        self.includedPages = { }
+        """
+        Maps the names of the pages in `includedPages` to whether the user
+        of the request may read them. Empty if the request has no user.
+        @type: { unicode: bool, ... }
+        """
+        self.includeAccess = { }
+        """
+        Attachments passed to the `attachmentUrl` callback by this rendering
+        or the renderings of included pages as pairs of the name of the page
+        and the file name. The output changes when these change.
+        @type: set
+        """
+        self.attachments = set()
+        """
+        Maps the names of wikis linked to directly or by included pages to
+        their URLs in the interwiki map. Names of pages looking like interwiki
+        links to unknown wikis map the prefix to ``None``. The output changes
+        when these entries change.
+        @type: { unicode: unicode, ... }
+        """
+        self.interwikiNames = { }
+        """
+        Names of the pages including this rendering starting with the page
+        rendered at the top. Empty for that page itself.
+        @type: [ unicode, ... ]
+        """
+        self._includeStack = [ ]
+        """
+        Was an include skipped because it would include a page which
+        includes this one? The rendering then depends on the pages including
+        it.
+        @type: bool
+        """
+        self._includeCycle = False
+        """
+        Output links to pages and attachments with absolute names so the
+        output does not depend on the page it is included in.
+        @type: bool
+        """
+        self._absoluteLinks = False
 
     # Helpers #################################################################
     
@@ -192,9 +365,6 @@ class Formatter(FormatterBase):
         # TODO A link as the only content of a line - such as in a category tag
         #      - results in a line starting with a space destroying indentation
         
-        indentation = u" " * self._indentation
-        result = u""
-
         # MoinMoin parser adds an ugly space to every paragraph - compensate
         # for this
         if self._spacePending:
@@ -203,7 +373,22 @@ class Formatter(FormatterBase):
         if string.endswith(u" "):
             string = string[:-1]
             self._spacePending = True
+        if not string:
+            return u""
+
+        if len(self._indentString) != self._indentation:
+            self._indentString = u" " * self._indentation
+        indentation = self._indentString
 
+        if u"\n" not in string:
+            # Most common case of a part of a line
+            if self._lastLineComplete:
+                # Indent new, non-empty line
+                string = indentation + string
+            self._lastLineComplete = False
+            return string
+
+        result = [ ]
         lines = string.split(u"\n")
         lastLine = lines.pop()
         for line in lines:
@@ -212,30 +397,39 @@ class Formatter(FormatterBase):
                 line = line[:-1]
             if self._lastLineComplete and line:
                 # Indent new, non-empty line
-                result += indentation
-            result += line + u"\n"
+                result.append(indentation)
+            result.append(line)
+            result.append(u"\n")
             self._lastLineComplete = True
 
         if lastLine:
             # Last line never has a trailing linefeed
             if self._lastLineComplete:
                 # Indent new, non-empty line
-                result += indentation
-            result += lastLine
+                result.append(indentation)
+            result.append(lastLine)
             self._lastLineComplete = False
 
-        return result
+        return u"".join(result)
 
     def _output(self, string=u""):
         """
-        Saves string to current collector or returns it indented.
+        Saves string to current collector or returns it indented. If there
+        is a sink the indented string is written to it instead.
         """
-        self._sinceEOL += string
-        self._sinceBLK += string
+        if string:
+            self._sinceEOL = True
+            self._sinceBLK = True
         if not self._collectors:
+            if self._sink is not None:
+                self._sink.write(self._indent(string))
+                return u""
             return self._indent(string)
 
-        self._collectors[-1] += string
+        collector = self._collectors[-1]
+        if collector is self._cellCollector:
+            string = self._indent(string)
+        collector.append(string)
         return u""
 
     # TODO Wiki parser creates empty paragraphs or paragraphs containing only
@@ -248,7 +442,7 @@ class Formatter(FormatterBase):
         if self._sinceEOL:
             # More than empty strings have been output
             result += self._output(u"\n")
-        self._sinceEOL = u""
+        self._sinceEOL = False
         return result
 
     def _output_EOL_BLK(self, string=u""):
@@ -256,10 +450,22 @@ class Formatter(FormatterBase):
         if self._sinceBLK:
             # More than empty strings have been output
             result += self._output(u"\n")
-        self._sinceEOL = u""
-        self._sinceBLK = u""
+        self._sinceEOL = False
+        self._sinceBLK = False
         return result
 
+    def _addLinkTarget(self, description, url):
+        """
+        Register `description` as a link target for `url`. Targets are output
+        by `endContent()` grouped by URL.
+        """
+        self._description2Url[description] = url
+        descriptions = self._url2Descriptions.get(url)
+        if descriptions is None:
+            descriptions = self._url2Descriptions[url] = [ ]
+            self._urls.append(url)
+        descriptions.append(description)
+
     _reColon = re.compile(":")
     _reBacktick = re.compile("`")
 
@@ -405,8 +611,8 @@ class Formatter(FormatterBase):
             ( instruction,
               arguments, ) = self._reHeaderLine2.search(headerLine).groups()
             result += self._header(instruction, arguments)
-        if result:
-            result += self._output_EOL_BLK()
+        # There is always at least the format instruction
+        result += self._output_EOL_BLK()
         return result
 
     def endDocument(self):
@@ -425,38 +631,31 @@ class Formatter(FormatterBase):
         return result
 
     def endContent(self):
-        result = u""
-
-        result += self.macro(None, u"FootNote", None)
-
-        description_urls = self._description_urls[:]
-        while description_urls:
-            sameUrls = [ description_urls.pop(0), ]
-            url = sameUrls[0][1]
-            i = 0
-            while i < len(description_urls):
-                if description_urls[i][1] == url:
-                    sameUrls.append(description_urls.pop(i))
-                else:
-                    i += 1
-            lastDescription = sameUrls.pop()[0]
-            for ( description, url, ) in sameUrls:
-                result += self._output_EOL(u".. _%s:"
-                                           % ( self._quoteLinkDescription(description), ))
-            result += self._output_EOL_BLK(u".. _%s: %s"
-                                           % ( self._quoteLinkDescription(lastDescription),
-                                               url, ))
+        result = [ ]
+        if (self._footnotes or self._description2Url
+            or self._substitution2Image):
+            # Add a separator line - before anything else because with a sink
+            # output can't be prepended later
+            result.append(self.comment(self._instructionPrefix
+                                       + self._instructionComment + u" "
+                                       + "#" * 76))
+
+        result.append(self.macro(None, u"FootNote", None))
+
+        for url in self._urls:
+            descriptions = self._url2Descriptions[url]
+            lastDescription = descriptions[-1]
+            for description in descriptions[:-1]:
+                result.append(self._output_EOL(u".. _%s:"
+                                               % ( self._quoteLinkDescription(description), )))
+            result.append(self._output_EOL_BLK(u".. _%s: %s"
+                                               % ( self._quoteLinkDescription(lastDescription),
+                                                   url, )))
 
         for ( substitution, image, ) in self._substitution2Image.items():
-            result += self._output_EOL_BLK(u".. |%s| image:: %s"
-                                           % ( substitution, image, ))
-        if result:
-            # Add a separator line
-            result = self.comment(self._instructionPrefix
-                                  + self._instructionComment + u" "
-                                  + "#" * 76) + result
-
-        return result
+            result.append(self._output_EOL_BLK(u".. |%s| image:: %s"
+                                               % ( substitution, image, )))
+        return u"".join(result)
 
     # Links ###################################################################
 
@@ -485,15 +684,30 @@ class Formatter(FormatterBase):
         if on:
             if not pagename and page:
                 pagename = page.page_name
+            if u":" in pagename:
+                # Would be an interwiki link if the wiki were known
+                self._useInterwikiName(pagename.split(u":", 1)[0])
+        return self._pageLink(on, pagename, kw.get('anchor', ""))
+
+    def _pageLink(self, on, pagename, anchor=""):
+        """
+        Create a link to `pagename` relative to the current page.
+        """
+        if on:
             url = self.request.normalizePagename(pagename)
             urlPath = url.split("/")
             thisPath = self.request.normalizePagename(self.page.page_name).split("/")
+            if self._absoluteLinks:
+                # Keep the full name
+                thisPath = None
             while urlPath and thisPath and urlPath[0] == thisPath[0]:
                 # Delete common entries
                 urlPath.pop(0)
                 thisPath.pop(0)
 
-            if len(thisPath) == 1 and len(urlPath) >= 1:
+            if thisPath is None:
+                pass
+            elif len(thisPath) == 1 and len(urlPath) >= 1:
                 # Siblings and their children differ starting at the last path
                 # element
                 url = u"%s%s" % ( wikiutil.PARENT_PREFIX, "/".join(urlPath), )
@@ -501,7 +715,6 @@ class Formatter(FormatterBase):
                 # Children and their children differ below the parent element
                 url = u"%s%s" % ( wikiutil.CHILD_PREFIX, "/".join(urlPath), )
 
-            anchor = kw.get('anchor', "")
             if anchor:
                 url = u"%s#%s" % ( url, anchor, )
             return self._link(on, url)
@@ -509,7 +722,18 @@ class Formatter(FormatterBase):
             return self._link(on)
 
     def interwikilink(self, on, interwiki='', pagename='', **kw):
-        return self.pagelink(on, "wiki:%s:%s" % ( interwiki, pagename, ))
+        if on:
+            self._useInterwikiName(interwiki)
+        return self._pageLink(on, "wiki:%s:%s" % ( interwiki, pagename, ))
+
+    def _useInterwikiName(self, name):
+        """
+        Record that the output depends on the entry for wiki `name` in the
+        interwiki map.
+        """
+        if name not in self.interwikiNames:
+            interwikiMap = wikiutil.load_wikimap(self.request)
+            self.interwikiNames[name] = interwikiMap.get(name)
             
     def url(self, on, url=None, css=None, **kw):
         """
@@ -527,17 +751,46 @@ class Formatter(FormatterBase):
 
     # Attachments #############################################################
 
-    def _attachment(self, type, url, text=None):
+    def _attachmentTarget(self, type, url):
+        """
+        @return: Reference to the attachment `url` in the markup for `type`
+                 and the URL to link to.
+        @rtype: ( unicode, unicode, )
+        """
+        ( pageName, fileName, ) = AttachFile.absoluteName(url,
+                                                          self.page.page_name)
+        if self._absoluteLinks:
+            url = u"%s/%s" % ( pageName, fileName, )
         link = u"%s:%s" % ( type, url, )
-        pre = self._link(True, link)
+        if self._attachmentUrl is not None:
+            if type == u"drawing":
+                # The rendering of a drawing
+                fileName += u".png"
+            fileName = wikiutil.taintfilename(fileName)
+            self.attachments.add(( pageName, fileName, ))
+            exported = self._attachmentUrl(pageName, fileName)
+            if exported is not None:
+                return ( link, exported, )
+        return ( link, link, )
+
+    def _attachment(self, type, url, text=None):
+        ( link, target, ) = self._attachmentTarget(type, url)
+        pre = self._link(True, target)
         if not text:
             text = link
         body = self.text(text)
         post = self._link(False)
         return pre + body + post
 
-    def attachment_link(self, url, text, **kw):
-        return self._attachment(u"attachment", url, text)
+    def attachment_link(self, on, url=None, **kw):
+        """
+        @param url: Given only if `on`. The link text is output in between.
+        """
+        if on:
+            return self._link(on, self._attachmentTarget(u"attachment",
+                                                         url)[1])
+        else:
+            return self._link(on)
 
     def attachment_image(self, url, **kw):
         return self._attachment(u"attachment", url)
@@ -616,15 +869,19 @@ class Formatter(FormatterBase):
     #      reflected properly; difficult to do, however
 
     def _inlineBegin(self, style):
-        self._collectors.append(u"")
+        self._collectors.append([ ])
         return self._output()
 
+    # Whitespace as matched by `\s` without `re.UNICODE`
+    _whitespace = u" \t\n\r\f\v"
+
     def _inlineEnd(self, style):
-        content = self._collectors.pop()
+        content = u"".join(self._collectors.pop())
 
-        ( preWhite, content,
-          postWhite, ) = re.search("^(\s*)(.*?)(\s*)$", content,
-                                   re.DOTALL).groups()
+        stripped = content.lstrip(self._whitespace)
+        preWhite = content[:len(content) - len(stripped)]
+        content = stripped.rstrip(self._whitespace)
+        postWhite = stripped[len(content):]
         if not content:
             # Skip empty inline markup
             return self._output(preWhite + postWhite)
@@ -633,51 +890,60 @@ class Formatter(FormatterBase):
 
     def _handleInline(self, on, style=None):
         """
-        @param style: Inline style to use. Used only if `on`. Must be a new
-                      instance for every call wiht `on`.
+        @param style: Inline style to use. Used only if `on`.
         @type style: Style
         """
+        styles = self._styles
         result = u""
         if on:
-            style.previous = self._currentStyle
-            if style.previous:
+            if styles:
                 # Suspend previous style
-                result += self._inlineEnd(style.previous)
+                result += self._inlineEnd(styles[-1])
             result += self._inlineBegin(style)
-            self._currentStyle = style
+            styles.append(style)
             return result
         else:
-            style = self._currentStyle
-            result += self._inlineEnd(style)
-            self._currentStyle = style.previous
-            if self._currentStyle:
+            result += self._inlineEnd(styles.pop())
+            if styles:
                 # Resume previous style
-                result += self._inlineBegin(self._currentStyle)
+                result += self._inlineBegin(styles[-1])
             return result
 
+    _strongStyle = Style('strong', u"**", u"**")
+    _emphasisStyle = Style('emphasis', u"*", u"*")
+    _underlineStyle = Style('underline')
+    _highlightStyle = Style('highlight')
+    _superscriptStyle = Style('superscript')
+    _subscriptStyle = Style('subscript')
+    _strikeStyle = Style('strike')
+    _literalStyle = Style('literal', u"``", u"``")
+    _smallStyle = Style('small')
+    _bigStyle = Style('big')
+    _iconStyle = Style('icon')
+
     def strong(self, on, **kw):
-        return self._handleInline(on, Style('strong', u"**", u"**"))
+        return self._handleInline(on, self._strongStyle)
 
     def emphasis(self, on, **kw):
-        return self._handleInline(on, Style('emphasis', u"*", u"*"))
+        return self._handleInline(on, self._emphasisStyle)
 
     def underline(self, on, **kw):
-        return self._handleInline(on, Style('underline'))
+        return self._handleInline(on, self._underlineStyle)
 
     def highlight(self, on, **kw):
-        return self._handleInline(on, Style('highlight'))
+        return self._handleInline(on, self._highlightStyle)
 
     def sup(self, on, **kw):
-        return self._handleInline(on, Style('superscript'))
+        return self._handleInline(on, self._superscriptStyle)
 
     def sub(self, on, **kw):
-        return self._handleInline(on, Style('subscript'))
+        return self._handleInline(on, self._subscriptStyle)
 
     def strike(self, on, **kw):
-        return self._handleInline(on, Style('strike'))
+        return self._handleInline(on, self._strikeStyle)
 
     def code(self, on, **kw):
-        return self._handleInline(on, Style('literal', u"``", u"``"))
+        return self._handleInline(on, self._literalStyle)
 
     def preformatted(self, on, **kw):
         # Maintain the accessible flag `in_pre`
@@ -692,10 +958,10 @@ class Formatter(FormatterBase):
             return self._output_EOL_BLK()
 
     def small(self, on, **kw):
-        return self._handleInline(on, Style('small'))
+        return self._handleInline(on, self._smallStyle)
 
     def big(self, on, **kw):
-        return self._handleInline(on, Style('big'))
+        return self._handleInline(on, self._bigStyle)
 
     # Special markup for syntax highlighting ##################################
 
@@ -735,7 +1001,7 @@ class Formatter(FormatterBase):
 
     def icon(self, type):
         # Called by macro `Icon`
-        result = self._handleInline(1, Style('icon'))
+        result = self._handleInline(1, self._iconStyle)
         result += self.text(type)
         result += self._handleInline(0)
         return result
@@ -747,6 +1013,8 @@ class Formatter(FormatterBase):
         Abstract class for all lists
         """
 
+        __slots__ = ( "_formatter", )
+
         def __init__(self, formatter):
             self._formatter = formatter
 
@@ -777,6 +1045,8 @@ class Formatter(FormatterBase):
 
     class BulletList(List):
 
+        __slots__ = ( )
+
         def __init__(self, formatter):
             Formatter.List.__init__(self, formatter)
 
@@ -785,6 +1055,8 @@ class Formatter(FormatterBase):
 
     class NumberList(List):
 
+        __slots__ = ( "_type", "_start", "_first", )
+
         def __init__(self, formatter, type, start):
             """
             @param type: Numbering type. One of ``None`` / ``1`` for arabic
@@ -812,6 +1084,8 @@ class Formatter(FormatterBase):
 
     class DefinitionList(List):
 
+        __slots__ = ( )
+
         def __init__(self, formatter):
             Formatter.List.__init__(self, formatter)
 
@@ -868,44 +1142,276 @@ class Formatter(FormatterBase):
         #      reST to make a definition item
         return self._openLists[-1].description(on)
 
+    # Decoration characters of headings by depth
+    _headingDecorations = u"=-~:,."
+
     def heading(self, on, depth, **kw):
         self._indentation = 0
         if on:
-            self._collectors.append(u"")
+            self._collectors.append([ ])
             return self._output()
         else:
-            heading = "".join(self._collectors.pop())
-            decoration = u"=-~:,."[depth - 1] * len(heading)
+            heading = u"".join(self._collectors.pop())
+            decoration = self._headingDecorations[depth - 1] * len(heading)
             return self._output_EOL(heading) + self._output_EOL_BLK(decoration)
 
     # Tables ##################################################################
-    
-    # TODO
+
+    # TODO Row spans are not supported. Tables containing them are not
+    #      converted. Column spans are filled up with empty cells.
+
+    class Table(object):
+        """
+        Cells of a table collected until its end. Column widths are kept up
+        to date while cells are added so no further pass over the cells is
+        needed for output.
+        """
+
+        __slots__ = ( "cells", "_rowStarts", "widths", "span",
+                      "rowSpanned", "outerState", )
+
+        def __init__(self):
+            """
+            Text of all cells row by row.
+            @type: [ str, ... ]
+            """
+            self.cells = [ ]
+            """
+            Index of the first cell of each row in `cells`.
+            @type: array.array
+            """
+            self._rowStarts = array.array('l')
+            """
+            Maximum width of the lines in each column.
+            @type: [ int, ... ]
+            """
+            self.widths = [ ]
+            """
+            Number of columns spanned by the current cell or ``None`` if
+            not in a cell.
+            @type: int
+            """
+            self.span = None
+            """
+            Whether a cell spans several rows. Such a table can not be
+            represented by the grid.
+            @type: bool
+            """
+            self.rowSpanned = False
+            """
+            Indentation state of the formatter outside of the current cell.
+            @type: tuple
+            """
+            self.outerState = None
+
+        def row(self):
+            self._rowStarts.append(len(self.cells))
+
+        def cell(self, text, span):
+            """
+            Add a cell to the current row.
+
+            @param span: Number of columns spanned.
+            @type span: int
+            """
+            if not self._rowStarts:
+                self.row()
+            column = len(self.cells) - self._rowStarts[-1]
+            if u"\n" in text:
+                width = max([ len(line) for line in text.split(u"\n") ])
+            else:
+                width = len(text)
+            self._widen(column, width)
+            self.cells.append(text)
+            for column in range(column + 1, column + span):
+                self._widen(column, 0)
+                self.cells.append(u"")
+
+        def _widen(self, column, width):
+            if column == len(self.widths):
+                self.widths.append(width)
+            elif width > self.widths[column]:
+                self.widths[column] = width
+
+        def rows(self):
+            """
+            Yield the non-empty rows with as many cells as there are columns.
+            """
+            columns = len(self.widths)
+            ends = self._rowStarts[1:]
+            ends.append(len(self.cells))
+            for ( start, end, ) in zip(self._rowStarts, ends):
+                if start == end:
+                    continue
+                row = self.cells[start:end]
+                if end - start < columns:
+                    row.extend([ u"", ] * (columns - (end - start)))
+                yield row
+
+    """
+    Maximum width of a grid table. Wider tables are output as list tables.
+    @type: int
+    """
+    _maxGridTableWidth = 120
+
+    _reSpan = re.compile(r"\d+")
 
     def table(self, on, attrs={}, **kw):
         if on:
-            self._collectors.append(u"")
-            return self._output()
+            result = self._output_EOL_BLK()
+            self._openTables.append(self.Table())
+            # Output outside of cells is dropped
+            self._collectors.append([ ])
+            return result
         else:
+            table = self._openTables.pop()
+            if table.span is not None:
+                # Cell not closed
+                self.table_cell(0)
             self._collectors.pop()
-            return self._output_EOL_BLK(u"[Table not converted]")
+            if table.rowSpanned:
+                return self._output_EOL_BLK(u"[Table not converted]")
+            return self._outputTable(table)
 
     def table_row(self, on, attrs={}, **kw):
-        return u""
+        if on:
+            self._openTables[-1].row()
+        return self._output()
 
     def table_cell(self, on, attrs={}, **kw):
-        return u""
+        table = self._openTables[-1]
+        if on:
+            # Parsers other than the wiki parser may pass no attributes as
+            # an empty string
+            attrs = attrs or { }
+            span = self._reSpan.search(attrs.get('rowspan', ""))
+            if span and int(span.group(0)) > 1:
+                table.rowSpanned = True
+            span = self._reSpan.search(attrs.get('colspan', ""))
+            if span:
+                table.span = max(int(span.group(0)), 1)
+            else:
+                table.span = 1
+            # Cell content is indented on its own
+            table.outerState = ( self._cellCollector, self._indentation,
+                                 self._lastLineComplete, self._spacePending, )
+            self._indentation = 0
+            self._lastLineComplete = True
+            self._spacePending = False
+            self._cellCollector = [ ]
+            self._collectors.append(self._cellCollector)
+        else:
+            text = u"".join(self._collectors.pop())
+            ( self._cellCollector, self._indentation, self._lastLineComplete,
+              self._spacePending, ) = table.outerState
+            table.outerState = None
+            table.cell(self._cellText(text), table.span)
+            table.span = None
+        return self._output()
+
+    def _cellText(self, text):
+        """
+        Remove blank lines around `text` and trailing whitespace from its
+        lines. Indentation is significant for blocks in the cell and is
+        kept except for the padding before the first line taken from the
+        cell markup.
+
+        @type text: unicode
+        @rtype: unicode
+        """
+        lines = [ line.rstrip() for line in text.split(u"\n") ]
+        while lines and not lines[-1]:
+            lines.pop()
+        start = 0
+        while start < len(lines) and not lines[start]:
+            start += 1
+        if start < len(lines):
+            lines[start] = lines[start].lstrip()
+        return u"\n".join(lines[start:])
+
+    def _outputTable(self, table):
+        """
+        Output `table` as a grid table if it is not too wide and as a list
+        table otherwise.
+        """
+        if not table.widths:
+            return self._output()
+        width = sum(table.widths) + 3 * len(table.widths) + 1
+        if width <= self._maxGridTableWidth:
+            return self._outputGridTable(table)
+        return self._outputListTable(table)
+
+    def _outputGridTable(self, table):
+        widths = table.widths
+        separator = u"+%s+\n" % ( u"+".join([ u"-" * (width + 2)
+                                             for width in widths ]), )
+        # Padding for each column and length of the cell text
+        paddings = [ u" " * (width + 1) for width in widths ]
+        result = [ self._output(separator) ]
+        for row in table.rows():
+            if [ cell for cell in row if u"\n" in cell ]:
+                cellLines = [ cell.split(u"\n") for cell in row ]
+            else:
+                cellLines = [ ( cell, ) for cell in row ]
+            height = max([ len(lines) for lines in cellLines ])
+            parts = [ ]
+            for i in range(height):
+                for ( lines, padding, ) in zip(cellLines, paddings):
+                    if i < len(lines):
+                        line = lines[i]
+                    else:
+                        line = u""
+                    parts.append(u"| ")
+                    parts.append(line)
+                    parts.append(padding[len(line):])
+                parts.append(u"|\n")
+            parts.append(separator)
+            result.append(self._output(u"".join(parts)))
+        # Every row ends with a linefeed already
+        self._sinceEOL = False
+        result.append(self._output_EOL_BLK())
+        return u"".join(result)
+
+    def _outputListTable(self, table):
+        result = [ self._output_EOL_BLK(u".. list-table::") ]
+        self._indentation += 3
+        for row in table.rows():
+            parts = [ ]
+            prefix = u"* - "
+            for cell in row:
+                lines = cell.split(u"\n")
+                parts.append(prefix)
+                parts.append(lines[0])
+                parts.append(u"\n")
+                for line in lines[1:]:
+                    if line:
+                        parts.append(u"    ")
+                        parts.append(line)
+                    parts.append(u"\n")
+                prefix = u"  - "
+            result.append(self._output(u"".join(parts)))
+        self._indentation -= 3
+        self._sinceEOL = False
+        result.append(self._output_EOL_BLK())
+        # An empty comment ends the directive so that a following
+        # indented paragraph is not taken as part of its content
+        result.append(self._output_EOL_BLK(u".."))
+        return u"".join(result)
 
     # Dynamic stuff / plugins #################################################
     
-    def macro(self, macroObj, name, argString):
+    def macro(self, macroObj, name, argString, **kw):
         """
         @type macroObj: wikimacro.Macro
         @param name: Name of the macro.
         @param argString: Unparsed parameter list or ``None``.
+        @keyword markup: Original markup of the macro call.
         """
         # TODO [[ImageLink()]] should be supported explicitly
-        # TODO [[Include()]] should be supported explicitly in simple cases
+        if name == u"Include":
+            result = self._include(argString)
+            if result is not None:
+                return result
         if name == u"TableOfContents":
             string = u".. contents::"
             if argString:
@@ -913,17 +1419,22 @@ class Formatter(FormatterBase):
         elif name == u"FootNote":
             if argString:
                 self._lastFootNote += 1
-                self._number2Footnote[self._lastFootNote] = argString
-                string = u"[%d]_" % ( self._lastFootNote, )
+                if self._footnotePrefix is None:
+                    label = u"%d" % ( self._lastFootNote, )
+                else:
+                    # Auto-numbered by docutils
+                    label = u"#%s-%d" % ( self._footnotePrefix,
+                                          self._lastFootNote, )
+                    self._footnotePrefixes.add(self._footnotePrefix)
+                self._footnotes.append(( label, argString, ))
+                string = u"[%s]_" % ( label, )
             else:
-                numbers = self._number2Footnote.keys()
-                numbers.sort()
-                result = u""
-                for number in numbers:
-                    result += self._output_EOL_BLK(u".. [%d] %s"
-                                                   % ( number, self._number2Footnote[number], ))
-                    del(self._number2Footnote[number])
-                return result
+                result = [ ]
+                for ( label, text, ) in self._footnotes:
+                    result.append(self._output_EOL_BLK(u".. [%s] %s"
+                                                       % ( label, text, )))
+                self._footnotes = [ ]
+                return u"".join(result)
         elif name in ( u"Anchor", u"BR", u"Icon", ):
             # These map to explicit methods
             return macroObj.execute(name, argString)
@@ -936,6 +1447,344 @@ class Formatter(FormatterBase):
             string += "]]`_"
         return self._output(string)
 
+    class IncludeOutput(object):
+        """
+        Receives everything written to the request while an included page is
+        rendered.
+        """
+
+        __slots__ = ( "parts", )
+
+        def __init__(self):
+            """
+            Output written so far.
+            @type: [ unicode, ... ]
+            """
+            self.parts = [ ]
+
+        def write(self, *data):
+            for part in data:
+                if isinstance(part, str):
+                    part = part.decode(config.charset)
+                self.parts.append(part)
+
+    class IncludedRendering(object):
+        """
+        Rendering of an included page as kept in `_includeCache`.
+        """
+
+        __slots__ = ( "text", "targets", "images", "includedPages",
+                      "includeAccess", "interwikiNames", "attachments",
+                      "footnotes", "footnotePrefixes", )
+
+        def __init__(self, text, formatter):
+            """
+            @param text: Output of the included page.
+            @type text: unicode
+            @param formatter: Formatter which rendered the included page.
+            @type formatter: Formatter
+            """
+            self.text = text
+            """
+            Link targets as pairs of description and URL.
+            @type: [ ( unicode, unicode, ), ... ]
+            """
+            self.targets = [ ( description, url, )
+                             for url in formatter._urls
+                             for description in formatter._url2Descriptions[url] ]
+            """
+            Substitutions as pairs of name and image.
+            @type: [ ( unicode, unicode, ), ... ]
+            """
+            self.images = formatter._substitution2Image.items()
+            """
+            Like `Formatter.includedPages` for the pages included in turn.
+            @type: { unicode: int, ... }
+            """
+            self.includedPages = formatter.includedPages
+            """
+            Like `Formatter.includeAccess` for the pages included in turn.
+            @type: { unicode: bool, ... }
+            """
+            self.includeAccess = formatter.includeAccess
+            """
+            Like `Formatter.interwikiNames`.
+            @type: { unicode: unicode, ... }
+            """
+            self.interwikiNames = formatter.interwikiNames
+            """
+            Like `Formatter.attachments`.
+            @type: set
+            """
+            self.attachments = formatter.attachments
+            """
+            Footnotes referenced by `text` and not output in it. These are
+            output by the including page.
+            @type: [ ( unicode, unicode, ), ... ]
+            """
+            self.footnotes = formatter._footnotes
+            """
+            Prefixes of the footnote labels in `text` and `footnotes`.
+            @type: set
+            """
+            self.footnotePrefixes = formatter._footnotePrefixes
+
+    _reIncludeArguments = re.compile(Include._args_re_pattern)
+
+    """
+    Renderings of included pages shared by all formatters of the process.
+    Maps the name and revision of the included page and the parent of the
+    page rendered at the top to the rendering. A rendering is used only if
+    the pages it includes in turn are unchanged and the user may read the
+    same of them. Cleared when it has `_maxIncludeCacheEntries` entries.
+    @type: { ( unicode, int, unicode, ): Formatter.IncludedRendering, ... }
+    """
+    _includeCache = { }
+    _maxIncludeCacheEntries = 1000
+
+    def _include(self, argString):
+        """
+        Expand an `[[Include()]]` of a single page without selecting parts of
+        it.
+
+        @return: Output or ``None`` if the call is not expanded.
+        @rtype: unicode
+        """
+        if not argString:
+            return None
+        arguments = self._reIncludeArguments.match(argString)
+        if (not arguments or arguments.group('name').startswith(u"^")
+            or [ group
+                 for group in ( 'from', 'to', 'sort', 'items', 'skipitems',
+                                'titlesonly', )
+                 if arguments.group(group) ]):
+            return None
+        name = wikiutil.AbsPageName(self.page.page_name,
+                                    arguments.group('name').strip())
+        stack = self._includeStack or [ self.page.page_name ]
+        if name in stack:
+            # Recursive include
+            self._includeCycle = True
+            return None
+        page = self.page.__class__(self.request, name)
+        if not page.exists():
+            self.includedPages[name] = 0
+            return None
+        revision = page.get_real_rev()
+        readable = self._mayRead(name)
+        if readable is not None:
+            self.includeAccess[name] = readable
+        if readable is False:
+            self.includedPages[name] = revision
+            return None
+
+        # Exported attachment links depend on the directory of the output
+        key = ( name, revision, u"/".join(stack[0].split(u"/")[:-1]), )
+        rendering = self._includeCache.get(key)
+        if rendering is None or not self._isCurrent(rendering):
+            try:
+                ( rendering, complete, ) = self._renderInclude(page,
+                                                               stack + [ name ])
+            except MemoryError:
+                # No fault of the page
+                raise
+            except Exception:
+                # Keep the reference to a page which can't be rendered
+                return None
+            if complete:
+                if len(self._includeCache) >= self._maxIncludeCacheEntries:
+                    self._includeCache.clear()
+                self._includeCache[key] = rendering
+            else:
+                self._includeCycle = True
+        self.includedPages[name] = revision
+        self.includedPages.update(rendering.includedPages)
+        self.includeAccess.update(rendering.includeAccess)
+        self.interwikiNames.update(rendering.interwikiNames)
+        self.attachments.update(rendering.attachments)
+        self._substitution2Image.update(rendering.images)
+
+        text = rendering.text
+        for ( description, url, ) in rendering.targets:
+            found = self._description2Url.get(description)
+            if found is None:
+                self._addLinkTarget(description, url)
+            elif found != url:
+                # The target is taken for another URL
+                text = self._anonymizeLink(text, description, url)
+        footnotes = rendering.footnotes
+        prefixes = set(rendering.footnotePrefixes)
+        for prefix in rendering.footnotePrefixes & self._footnotePrefixes:
+            # Footnotes of a page included more than once
+            fresh = self._freshFootnotePrefix(prefix, prefixes)
+            ( text, footnotes, ) = self._renameFootnotes(text, footnotes,
+                                                         prefix, fresh)
+            prefixes.discard(prefix)
+            prefixes.add(fresh)
+        self._footnotePrefixes.update(prefixes)
+        self._footnotes.extend(footnotes)
+
+        result = [ self._output_EOL_BLK() ]
+        if arguments.group('heading') and arguments.group('hquote'):
+            level = int(arguments.group('level') or 1)
+            result.append(self.heading(1, level))
+            result.append(self.text(arguments.group('htext') or name))
+            result.append(self.heading(0, level))
+            # Headings of the included page go below the added one
+            text = self._shiftHeadings(text, level + 1)
+        if text:
+            result.append(self._output_EOL_BLK(text))
+        return u"".join(result)
+
+    def _mayRead(self, pageName):
+        """
+        @return: Whether the user of the request may read `pageName` or
+                 ``None`` if the request has no user.
+        @rtype: bool
+        """
+        user = getattr(self.request, 'user', None)
+        if user is None:
+            return None
+        return bool(user.may.read(pageName))
+
+    def _isCurrent(self, rendering):
+        """
+        @return: Whether the pages included by `rendering` in turn are still
+                 at the same revisions and the user may read the same of
+                 them.
+        @rtype: bool
+        """
+        for ( pageName, revision, ) in rendering.includedPages.items():
+            page = self.page.__class__(self.request, pageName)
+            if (page.exists() and page.get_real_rev() or 0) != revision:
+                return False
+        for ( pageName, readable, ) in rendering.includeAccess.items():
+            if self._mayRead(pageName) != readable:
+                return False
+        return True
+
+    def _renderInclude(self, page, stack):
+        """
+        Render an included page with a formatter of its own.
+
+        @param stack: Names of the including pages and `page`.
+        @return: Entry for `_includeCache` and whether the rendering is
+                 independent of the including pages.
+        @rtype: ( Formatter.IncludedRendering, bool, )
+        """
+        request = self.request
+        formatter = Formatter(request, attachmentUrl=self._attachmentUrl)
+        formatter._includeStack = stack
+        formatter._absoluteLinks = True
+        formatter._footnotePrefix = u"i" + hashlib.md5(
+            page.page_name.encode(config.charset)).hexdigest()[:8]
+        formatter.setPage(page)
+
+        ( meta, data, ) = wikiutil.get_processing_instructions(page.get_raw_body())
+        format = request.cfg.default_markup or "wiki"
+        formatArgs = ""
+        for ( verb, args, ) in meta:
+            if verb == "format":
+                ( format, formatArgs, ) = (args + " ").split(" ", 1)
+                format = format.lower()
+                formatArgs = formatArgs.strip()
+        Parser = wikiutil.searchAndImportPlugin(request.cfg, "parser", format)
+        parser = Parser(data, request, format_args=formatArgs,
+                        start_line=len(meta))
+
+        output = self.IncludeOutput()
+        # Macros format with the formatter of the request
+        including = getattr(request, 'formatter', None)
+        request.formatter = formatter
+        request.redirect(output)
+        try:
+            parser.format(formatter)
+        finally:
+            request.redirect()
+            request.formatter = including
+
+        return ( self.IncludedRendering(u"".join(output.parts).strip(u"\n"),
+                                        formatter),
+                 not formatter._includeCycle, )
+
+    def _anonymizeLink(self, text, description, url):
+        """
+        @return: `text` with the references to the link target `description`
+                 replaced by anonymous references to `url`. Headings made
+                 longer by this get longer decorations.
+        @rtype: unicode
+        """
+        if LinkStyle._reWord.search(description):
+            reference = re.compile(u"(?<![-\\w`])%s_(?![\\w_])"
+                                   % ( re.escape(description), ), re.UNICODE)
+        else:
+            reference = re.compile(u"`%s`_(?!_)" % ( re.escape(description), ),
+                                   re.UNICODE)
+        replacement = u"`%s <%s>`__" % ( description, url, )
+        lines = text.split(u"\n")
+        for i in xrange(len(lines)):
+            line = reference.sub(lambda match: replacement, lines[i])
+            if line == lines[i]:
+                continue
+            decoration = i + 1 < len(lines) and lines[i + 1]
+            if (decoration and decoration[0] in self._headingDecorations
+                and decoration == decoration[0] * len(lines[i])):
+                lines[i + 1] = decoration[0] * len(line)
+            lines[i] = line
+        return u"\n".join(lines)
+
+    def _freshFootnotePrefix(self, prefix, taken):
+        """
+        @param taken: Prefixes in use besides those of this output.
+        @type taken: set
+        @return: A footnote prefix as long as `prefix` not used so far.
+        @rtype: unicode
+        """
+        number = 0
+        while True:
+            number += 1
+            fresh = u"i" + hashlib.md5("%s-%d" % ( prefix, number, )
+                                       ).hexdigest()[:len(prefix) - 1]
+            if fresh not in self._footnotePrefixes and fresh not in taken:
+                return fresh
+
+    def _renameFootnotes(self, text, footnotes, prefix, fresh):
+        """
+        @return: `text` and `footnotes` with the footnote labels starting
+                 with `prefix` relabeled to start with `fresh`. Both
+                 prefixes have the same length so the layout of the text is
+                 kept.
+        @rtype: ( unicode, [ ( unicode, unicode, ), ... ], )
+        """
+        old = u"[#%s-" % ( prefix, )
+        new = u"[#%s-" % ( fresh, )
+        return ( text.replace(old, new),
+                 [ ( label.replace(old[1:], new[1:]), footnoteText, )
+                   for ( label, footnoteText, ) in footnotes ], )
+
+    def _shiftHeadings(self, text, depth):
+        """
+        @return: `text` with all headings moved so the topmost ones have
+                 `depth`.
+        @rtype: unicode
+        """
+        lines = text.split(u"\n")
+        headings = [ i
+                     for i in xrange(1, len(lines))
+                     if (lines[i] and lines[i][0] in self._headingDecorations
+                         and lines[i] == lines[i][0] * len(lines[i])
+                         and len(lines[i - 1]) == len(lines[i])
+                         and (i == 1 or not lines[i - 2])) ]
+        if not headings:
+            return text
+        indexes = [ self._headingDecorations.index(lines[i][0])
+                    for i in headings ]
+        shift = depth - 1 - min(indexes)
+        for ( i, index, ) in zip(headings, indexes):
+            index = min(index + shift, len(self._headingDecorations) - 1)
+            lines[i] = self._headingDecorations[index] * len(lines[i])
+        return u"\n".join(lines)
+
     def processor(self, processorName, lines, isParser=0):
         """
         Create output which should be renderded by a certain parser.
@@ -959,6 +1808,9 @@ class Formatter(FormatterBase):
         return u""
     
     def rawHTML(self, markup):
+        if not markup:
+            # The wiki parser passes empty error messages here
+            return self._output()
         result = self._output_EOL(".. raw:: html")
         self._indentation += 3
         if not isinstance(markup, basestring):